@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Micro-benchmark ETag generation.
+
+Compares the old read-and-concatenate ETag code with webotron.etag, both
+serially and with a process pool, and prints MB/s for each file size.
+With webotron installed (pip install -e .) run:
+
+    python benchmarks/etag_bench.py --sizes small,medium,large
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+from hashlib import md5
+import os
+import tempfile
+import time
+
+import click
+
+from webotron.bucket import BucketManager
+from webotron.etag import compute_etag
+
+MB = 1024 * 1024
+SIZES = {
+    'small': 64 * 1024,
+    'medium': 64 * MB,
+    'large': 5 * 1024 * MB,
+}
+
+
+def legacy_etag(path, chunk_size):
+    """Generate etag the way BucketManager.gen_etag used to."""
+    hashes = []
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            hash_ = md5()
+            hash_.update(data)
+            hashes.append(hash_)
+    if not hashes:
+        return None
+    if len(hashes) == 1:
+        return '"{}"'.format(hashes[0].hexdigest())
+    hash_ = md5(reduce(lambda x, y: x + y, (h.digest() for h in hashes)))
+    return '"{}-{}"'.format(hash_.hexdigest(), len(hashes))
+
+
+def make_file(directory, size):
+    """Write a file of size bytes of random data and return its path."""
+    path = os.path.join(directory, 'bench-{}.bin'.format(size))
+    block = os.urandom(MB)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            written = f.write(block[:min(MB, remaining)])
+            remaining -= written
+
+    return path
+
+
+def measure(func, path, size, repeat):
+    """Return the best throughput of func(path) in MB/s and its result."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return (size / MB / max(best, 1e-9), result)
+
+
+@click.command()
+@click.option('--sizes', default='small,medium', show_default=True,
+              help="Comma separated sizes from: {}.".format(
+                  ', '.join(SIZES)))
+@click.option('--processes', default=os.cpu_count(), show_default=True,
+              help="Processes for the pooled run.")
+@click.option('--repeat', default=3, show_default=True,
+              help="Runs per measurement; the best one is reported.")
+def main(sizes, processes, repeat):
+    """Print ETag throughput for each file size."""
+    chunk_size = BucketManager.CHUNK_SIZE
+    with tempfile.TemporaryDirectory() as directory, \
+            ProcessPoolExecutor(max_workers=processes) as pool:
+        for name in sizes.split(','):
+            size = SIZES[name]
+            path = make_file(directory, size)
+            runs = [
+                ('legacy', lambda p: legacy_etag(p, chunk_size)),
+                ('streaming', lambda p: compute_etag(p, chunk_size)),
+                ('pooled', lambda p: compute_etag(p, chunk_size, pool=pool)),
+            ]
+            etags = set()
+            for (label, func) in runs:
+                (rate, etag) = measure(func, path, size, repeat)
+                etags.add(etag)
+                print("{:>7} {:>10} {:10.1f} MB/s".format(name, label, rate))
+            assert len(etags) == 1, "ETag implementations disagree"
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Benchmark BucketManager.sync against an in-process S3.
+
+Generates synthetic site trees of mixed file sizes and syncs each one to
+a moto mocked bucket, with optional added latency per API call, through
+four scenarios: a cold sync to an empty bucket, a no-op resync, a resync
+after changing 1% of the files and a resync after deleting half of them.
+Each scenario runs with a new BucketManager, as a new webotron run would.
+Throughput and API call counts are printed and written as JSON, and a
+previous run's JSON given as --baseline is compared against.  With
+webotron installed (pip install -e .) and moto 5 or later run:
+
+    python benchmarks/sync_bench.py --trees 1k,10k --latency 20 \
+        --output sync-bench.json --baseline sync-bench-old.json
+"""
+
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+
+import boto3
+import click
+from moto import mock_aws
+
+from webotron.bucket import BucketManager
+from webotron.etagindex import EtagIndex
+from webotron.journal import SyncJournal
+from webotron.metrics import Metrics
+
+MB = 1024 * 1024
+TREES = {
+    '1k': 1000,
+    '10k': 10000,
+    '100k': 100000,
+}
+# (smallest, largest, weight) of the file sizes in a tree
+SIZE_MIX = [
+    (100, 2048, 50),
+    (2048, 32768, 35),
+    (32768, 131072, 15),
+]
+# one file in this many is large enough for a multipart upload
+LARGE_EVERY = 2000
+LARGE_SIZE = BucketManager.CHUNK_SIZE + MB
+EXTENSIONS = ['html', 'css', 'js', 'png', 'jpg', 'json']
+FILES_PER_DIR = 50
+CHANGE_FRACTION = 0.01
+DELETE_FRACTION = 0.5
+BUCKET = 'webotron-bench'
+
+
+class SiteTree:
+    """A synthetic site tree whose layout is fixed by a seed.
+
+    Every file starts with its key and a version number, so no two files
+    share content and a changed file differs from its old self.
+    """
+
+    def __init__(self, root, files, seed=0):
+        """Create a SiteTree object for files files under root."""
+        self.root = root
+        self.rng = random.Random(seed)
+        self.block = self.rng.getrandbits(8 * MB).to_bytes(MB, 'little')
+        self.sizes = {}
+        for number in range(files):
+            key = 'd{}/s{}/f{}.{}'.format(
+                number // (FILES_PER_DIR ** 2),
+                number // FILES_PER_DIR % FILES_PER_DIR, number,
+                self.rng.choice(EXTENSIONS))
+            if number % LARGE_EVERY == LARGE_EVERY - 1:
+                size = LARGE_SIZE
+            else:
+                (low, high, _) = self.rng.choices(
+                    SIZE_MIX, [weight for (_, _, weight) in SIZE_MIX])[0]
+                size = self.rng.randint(low, high)
+            self.sizes[key] = size
+
+    def path(self, key):
+        """Get the local path of key."""
+        return os.path.join(self.root, *key.split('/'))
+
+    def write(self, key, version=0):
+        """Write the content of key at version."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = self.sizes[key]
+        header = '{} v{}\n'.format(key, version).encode('utf-8')
+        offset = self.rng.randrange(len(self.block))
+        with open(path, 'wb') as f:
+            f.write(header[:size])
+            remaining = max(0, size - len(header))
+            while remaining:
+                data = self.block[offset:offset + remaining]
+                f.write(data)
+                remaining -= len(data)
+                offset = 0
+
+    def build(self):
+        """Write every file."""
+        for key in self.sizes:
+            self.write(key)
+
+    def change(self, fraction):
+        """Rewrite a fraction of the files; return how many."""
+        keys = self.rng.sample(sorted(self.sizes),
+                               max(1, int(len(self.sizes) * fraction)))
+        for key in keys:
+            self.write(key, version=1)
+
+        return len(keys)
+
+    def remove(self, fraction):
+        """Delete a fraction of the files; return how many."""
+        keys = self.rng.sample(sorted(self.sizes),
+                               int(len(self.sizes) * fraction))
+        for key in keys:
+            os.remove(self.path(key))
+            del self.sizes[key]
+
+        return len(keys)
+
+
+def git_commit():
+    """Get the commit of the webotron checkout, or None."""
+    try:
+        return subprocess.run(
+            ['git', '-C', os.path.dirname(os.path.abspath(__file__)),
+             'rev-parse', 'HEAD'], check=True, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL).stdout.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_sync(session, tree, workdir, options):
+    """Sync tree to the bench bucket; return its result dict."""
+    manager = BucketManager(session)
+    client = manager.s3.meta.client
+    metrics = Metrics()
+    metrics.register(client)
+    manager.metrics = metrics
+    if options['latency']:
+        def delay(**kwargs):
+            time.sleep(options['latency'] / 1000)
+        client.meta.events.register('before-call.s3', delay)
+    index = EtagIndex(os.path.join(workdir, 'etags.json')) \
+        if options['etag_index'] else None
+    journal = SyncJournal(os.path.join(workdir, 'journal.jsonl')) \
+        if options['journal'] else None
+
+    started = time.perf_counter()
+    # sync prints a line per file, which would swamp the results
+    try:
+        with redirect_stdout(io.StringIO()):
+            summary = manager.sync(tree.root, BUCKET,
+                                   workers=options['workers'],
+                                   etag_index=index,
+                                   list_shards=options['list_shards'],
+                                   journal=journal)
+    finally:
+        if journal is not None:
+            journal.close()
+    seconds = time.perf_counter() - started
+
+    data = metrics.to_dict()
+    calls = {call['operation']: call['calls'] for call in data['api_calls']}
+    files = len(tree.sizes)
+
+    return {
+        'seconds': seconds,
+        'files': files,
+        'bytes': sum(tree.sizes.values()),
+        'files_per_second': files / seconds,
+        'sent_mib_per_second': data['bytes']['sent'] / MB / seconds,
+        'bytes_sent': data['bytes']['sent'],
+        'bytes_hashed': data['bytes']['hashed'],
+        'uploaded': len(summary.uploaded),
+        'copied': len(summary.copied),
+        'skipped': len(summary.skipped),
+        'deleted': len(summary.deleted),
+        'failed': len(summary.failed),
+        'api_calls': calls,
+        'api_calls_total': sum(calls.values()),
+        'peak_memory_bytes': data['peak_memory_bytes'],
+    }
+
+
+def run_tree(name, options):
+    """Run every scenario on a new tree of size name, yielding results."""
+    with tempfile.TemporaryDirectory() as workdir, mock_aws():
+        session = boto3.Session(region_name='us-east-1')
+        session.client('s3').create_bucket(Bucket=BUCKET)
+        tree = SiteTree(os.path.join(workdir, 'site'), TREES[name],
+                        options['seed'])
+        tree.build()
+        scenarios = [
+            ('cold', lambda: None),
+            ('noop', lambda: None),
+            ('change', lambda: tree.change(CHANGE_FRACTION)),
+            ('delete', lambda: tree.remove(DELETE_FRACTION)),
+        ]
+        for (scenario, prepare) in scenarios:
+            prepare()
+            result = run_sync(session, tree, workdir, options)
+            result.update(tree=name, scenario=scenario)
+            yield result
+
+
+def compare(result, baseline):
+    """Describe how result differs from the same run in baseline."""
+    for old in baseline.get('results', []):
+        if (old['tree'], old['scenario']) == \
+                (result['tree'], result['scenario']):
+            return '  {:+6.1%} time, {:+d} calls vs baseline'.format(
+                result['seconds'] / max(old['seconds'], 1e-9) - 1,
+                result['api_calls_total'] - old['api_calls_total'])
+
+    return ''
+
+
+@click.command()
+@click.option('--trees', default='1k', show_default=True,
+              help="Comma separated tree sizes from: {}.".format(
+                  ', '.join(TREES)))
+@click.option('--workers', default=8, show_default=True,
+              type=click.IntRange(1, BucketManager.MAX_WORKERS),
+              help="Sync workers.")
+@click.option('--list-shards', default=1, show_default=True,
+              type=click.IntRange(1, BucketManager.MAX_WORKERS),
+              help="Key prefixes listed in parallel.")
+@click.option('--latency', default=0.0, show_default=True,
+              type=click.FloatRange(0), metavar='MS',
+              help="Milliseconds added to every S3 API call.")
+@click.option('--etag-index/--no-etag-index', default=True,
+              show_default=True, help="Use an etag index, as sync does.")
+@click.option('--journal/--no-journal', default=True, show_default=True,
+              help="Use a sync journal, as sync does.")
+@click.option('--seed', default=0, show_default=True,
+              help="Seed for the tree layout and the files changed.")
+@click.option('--output', default=None, type=click.Path(),
+              help="Write the results to this JSON file.")
+@click.option('--baseline', default=None,
+              type=click.Path(exists=True, dir_okay=False),
+              help="Compare with the results in this JSON file.")
+def main(trees, workers, list_shards, latency, etag_index, journal, seed,
+         output, baseline):
+    """Print sync throughput and API calls for each tree and scenario."""
+    options = {
+        'workers': workers,
+        'list_shards': list_shards,
+        'latency': latency,
+        'etag_index': etag_index,
+        'journal': journal,
+        'seed': seed,
+    }
+    if baseline:
+        with open(baseline, 'r') as f:
+            baseline = json.load(f)
+    results = []
+    for name in trees.split(','):
+        for result in run_tree(name, options):
+            results.append(result)
+            print("{:>5} {:>7} {:8.2f}s {:9.0f} files/s {:7.1f} MiB/s "
+                  "{:7d} calls{}".format(
+                      result['tree'], result['scenario'], result['seconds'],
+                      result['files_per_second'],
+                      result['sent_mib_per_second'],
+                      result['api_calls_total'],
+                      compare(result, baseline) if baseline else ''))
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({
+                'created': datetime.now(timezone.utc).isoformat(),
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'options': options,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for BucketManager against an in-process S3."""
+
+import boto3
+from moto import mock_aws
+import pytest
+
+from webotron.bucket import BucketManager
+
+BUCKET = 'webotron-test'
+
+
+@pytest.fixture
+def session(monkeypatch, tmp_path):
+    """Yield a session on a mocked S3 holding an empty bucket."""
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    with mock_aws():
+        session = boto3.Session(region_name='us-east-1')
+        session.client('s3').create_bucket(Bucket=BUCKET)
+        yield session
+
+
+def test_dedup_does_not_copy_from_overwritten_key(session, tmp_path):
+    """Content moved between keys ends up under the right key."""
+    old = b'o' * BucketManager.DEDUP_MIN_SIZE
+    new = b'n' * BucketManager.DEDUP_MIN_SIZE
+    client = session.client('s3')
+    client.put_object(Bucket=BUCKET, Key='a.js', Body=old)
+    site = tmp_path / 'site'
+    site.mkdir()
+    (site / 'a.js').write_bytes(new)
+    (site / 'b.js').write_bytes(old)
+
+    BucketManager(session).sync(str(site), BUCKET, workers=1, dedup=True)
+
+    for (key, body) in [('a.js', new), ('b.js', old)]:
+        assert client.get_object(Bucket=BUCKET,
+                                 Key=key)['Body'].read() == body
@@ -2,32 +2,70 @@
 
 """Classes for S3 Buckets."""
 
-from pathlib import Path
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+import json
 import mimetypes
-from functools import reduce
+import os
+import threading
 from hashlib import md5
+from itertools import islice
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 from webotron import util
+from webotron.etag import candidate_part_sizes, compute_etag, one_part_etag
+from webotron.gitdelta import GitDelta
+from webotron.listing import iter_objects
+from webotron.manifest import Manifest
+from webotron.scanner import scan_tree
+from webotron.sync import SyncPipeline, SyncSummary
+from webotron.throttle import AdaptiveThrottle
 
 
 class BucketManager:
     """Manage an S3 Bucket."""
 
     CHUNK_SIZE = 8388608
+    # DeleteObjects accepts at most this many keys per request
+    DELETE_BATCH_SIZE = 1000
+    # upper bound for sync --workers; the shared client's connection pool
+    # is sized to match so parallel uploads don't fight over connections
+    MAX_WORKERS = 64
+    # attempts per request; throttled requests are retried with backoff
+    MAX_ATTEMPTS = 10
+    # below this size uploading a file costs about as much as copying it
+    DEDUP_MIN_SIZE = 16384
 
     def __init__(self, session):
         """Create a BucketManager object."""
         self.session = session
-        self.s3 = self.session.resource('s3')
+        self.s3 = self.session.resource('s3', config=Config(
+            max_pool_connections=self.MAX_WORKERS,
+            retries={'mode': 'standard', 'max_attempts': self.MAX_ATTEMPTS}
+        ))
+        # shared by every request made through the client
+        self.throttle = AdaptiveThrottle(self.MAX_WORKERS)
+        self.throttle.register(self.s3.meta.client)
         self.transfer_config = boto3.s3.transfer.TransferConfig(
             multipart_chunksize=self.CHUNK_SIZE,
             multipart_threshold=self.CHUNK_SIZE
         )
 
-        self.manifest = {}
+        self.manifest = Manifest()
+        self.etag_index = None
+        self.cache_policy = None
+        self.hash_pool = None
+        self.journal = None
+        self.dedup = False
+        self.metrics = None
+        # etag: uploads in progress or done this sync, for dedup
+        self._blobs = {}
+        # keys written this sync, whose listed etag no longer holds
+        self._written = set()
+        self._blob_lock = threading.Lock()
 
     def get_bucket(self, bucket_name):
         """Get complete bucket entry when given the bucket name."""
@@ -55,6 +93,19 @@ class BucketManager:
         """Get an iterator for all objects in a bucket."""
         return self.s3.Bucket(bucket).objects.all()
 
+    def list_objects(self, bucket_name, prefix='', shards=1, limit=None):
+        """Yield the list_objects_v2 dict of each object under prefix.
+
+        Objects are streamed straight from the listing pages, without a
+        resource object per key, and listing stops after limit objects.
+        """
+        objects = iter_objects(self.s3.meta.client, bucket_name,
+                               prefix=prefix, shards=shards)
+        try:
+            yield from islice(objects, limit)
+        finally:
+            objects.close()
+
     def init_bucket(self, bucket_name):
         """Create new bucket or return exisitng one by name."""
         s3_bucket = None
@@ -108,21 +159,17 @@ class BucketManager:
             }
         })
 
-    def load_manifest(self, bucket):
-        """Load manifest for caching purposes."""
-        global bucket_chk
-        paginator = self.s3.meta.client.get_paginator('list_objects_v2')
-        bucket_chk = {}
-        for page in paginator.paginate(Bucket=bucket.name):
-            for obj in page.get('Contents', []):
-                # print(obj)
-                # print(obj['ETag'])
-                self.manifest[obj['Key']] = obj['ETag']
-                # print(self.manifest[obj['Key']])
-                # print(obj)
-                bucket_chk.update({obj['Key']: "no"})
-        # for (obj_key, obj_status) in bucket_chk.items():
-        #    print(obj_key, obj_status)
+    def load_manifest(self, bucket, shards=1):
+        """Load manifest for caching purposes.
+
+        shards > 1 lists that many prefixes of the bucket concurrently.
+        """
+        self.manifest = Manifest()
+        for obj in iter_objects(self.s3.meta.client, bucket.name,
+                                shards=shards):
+            # print(obj)
+            # print(obj['ETag'])
+            self.manifest.add(obj['Key'], obj['ETag'], obj['Size'])
 
     @staticmethod
     def hash_data(data):
@@ -132,81 +179,495 @@ class BucketManager:
 
         return hash
 
-    def gen_etag(self, path):
-        """Generate etag for file."""
-        hashes = []
-
-        with open(path, 'rb') as f:
-            while True:
-                data = f.read(self.CHUNK_SIZE)
-
-                if not data:
-                    # print("path1")
-                    break
-
-                hashes.append(self.hash_data(data))
-
-        if not hashes:
-            # print("path2 - 0 byte file?")
-            return
-        elif len(hashes) == 1:
-            # print("path3")
-            return '"{}"'.format(hashes[0].hexdigest())
-        else:
-            # print("path4")
-            hash = self.hash_data(reduce(lambda x, y: x + y,
-                                         (h.digest() for h in hashes)))
-            return '"{}-{}"'.format(hash.hexdigest(), len(hashes))
-
-    def upload_file(self, bucket, path, key):
-        """Upload object to S3 bucket."""
+    def gen_etag(self, path, chunk_size=None):
+        """Generate etag for file.
+
+        Large files are hashed by the process pool when one is set.
+        """
+        if self.metrics is not None:
+            self.metrics.add_bytes('hashed', os.path.getsize(path))
+
+        return compute_etag(path, chunk_size or self.CHUNK_SIZE,
+                            pool=self.hash_pool)
+
+    def file_etag(self, path, key, chunk_size=None, stat=None):
+        """Get etag for file, using the etag index when one is set.
+
+        stat is the file's stat result if the caller already has it.
+        """
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        if self.etag_index is None:
+            return self.gen_etag(path, chunk_size)
+
+        # stat before hashing so a file modified mid-hash is seen as
+        # changed on the next sync rather than cached with a stale etag
+        stat = stat or os.stat(path)
+        etag = self.etag_index.get(key, stat, chunk_size)
+        if etag is None:
+            etag = self.gen_etag(path, chunk_size)
+            self.etag_index.put(key, stat, chunk_size, etag)
+
+        return etag
+
+    def etag_matches(self, path, key, etag):
+        """Check if the local file at path has the same content as key.
+
+        etag is the local etag for CHUNK_SIZE parts.  If it differs from
+        the remote one, the remote object may have been uploaded with
+        another part size (console, aws cli, older webotron), so the etag
+        is recomputed for the part sizes that fit the remote part count.
+        """
+        if self.manifest.matches(key, etag):
+            return True
+
+        parts = self.manifest.parts(key)
+        size = os.path.getsize(path)
+        if parts is None or etag is None or self.manifest.size(key) != size:
+            return False
+
+        for part_size in candidate_part_sizes(size, parts):
+            if part_size == self.CHUNK_SIZE or \
+                    (parts <= 1 and size <= self.CHUNK_SIZE):
+                # our own etag already is the etag for this part size
+                candidate = etag
+            else:
+                candidate = self.file_etag(path, key, part_size)
+            if parts == 1:
+                candidate = one_part_etag(candidate)
+            elif candidate == etag:
+                continue
+            if self.manifest.matches(key, candidate):
+                return True
+
+        return False
+
+    def upload_file(self, bucket, path, key, etag=None, encoding=None):
+        """Upload object to S3 bucket.
+
+        etag is the file's etag if it has already been computed.  encoding
+        is the Content-Encoding of an already compressed file at path.
+        With dedup set, content already in the bucket or uploaded earlier
+        in the sync is copied server side instead of uploaded again.
+        Return 'skipped', 'copied' or 'uploaded'.  Safe to call from several
+        threads at once as the upload goes through the shared S3 client.
+        """
         content_type = mimetypes.guess_type(key)[0] or 'text/plain'
+        extra_args = {'ContentType': content_type}
+        if self.cache_policy is not None:
+            cache_control = self.cache_policy.cache_control(key)
+            if cache_control:
+                extra_args['CacheControl'] = cache_control
 
         # print("path being uploaded is", path)
         # print("key being uploaded is:", key)
-        etag = self.gen_etag(path)
-        bucket_chk[key] = "yes"
+        if etag is None:
+            etag = self.file_etag(path, key)
 
-        if self.manifest.get(key, '') == etag:
+        if encoding is not None:
+            extra_args['ContentEncoding'] = encoding
+            # compressed files are always uploaded by us in CHUNK_SIZE parts
+            matches = self.manifest.matches(key, etag)
+        else:
+            matches = self.etag_matches(path, key, etag)
+        if not matches and self.journal is not None:
+            # finished by an earlier, interrupted run of this sync
+            matches = self.journal.completed_etag(key) == etag
+        if matches:
             print("Skipping upload of {}-{} as etags match".format(key, path))
-            # note - if 0 byte file upload always occurs as local key is None
-            return
-
-        print("Uploading {}-{} etag mismatch or 0 byte file".format(key, path))
+            return 'skipped'
+
+        with self._blob_lock:
+            # from here on key no longer holds its listed content
+            self._written.add(key)
+        size = os.path.getsize(path)
+        blob = None
+        if self.dedup and size >= self.DEDUP_MIN_SIZE:
+            (source, blob) = self.claim_blob(etag)
+            if source is not None:
+                print("Copying {} from {} as etags match".format(key, source))
+                if self.copy_key(bucket, source, key, size, extra_args,
+                                 etag):
+                    if self.journal is not None:
+                        self.journal.record_done(key, etag)
+                    return 'copied'
+                print("{} changed during the sync, uploading {}".format(
+                    source, key))
+
+        print("Uploading {}-{} etag mismatch".format(key, path))
         # print("Local Key:  ",etag)
         # print("  AWS Key:  ",self.manifest.get(key, ''))
-        return bucket.upload_file(
-            path,
-            key,
-            ExtraArgs={
-                'ContentType': content_type
-            },
-            Config=self.transfer_config
+        try:
+            if self.journal is not None and size > self.CHUNK_SIZE:
+                self.upload_multipart(bucket, path, key, etag, extra_args)
+            else:
+                self.s3.meta.client.upload_file(
+                    path,
+                    bucket.name,
+                    key,
+                    ExtraArgs=extra_args,
+                    Config=self.transfer_config
+                )
+        except Exception:
+            if blob is not None:
+                # with no key set, waiting duplicates upload themselves
+                blob['done'].set()
+            raise
+        if blob is not None:
+            blob['key'] = key
+            blob['done'].set()
+        if self.journal is not None:
+            self.journal.record_done(key, etag)
+        return 'uploaded'
+
+    def claim_blob(self, etag):
+        """Find a key to copy content with etag from, or claim its upload.
+
+        Return a tuple of the key to copy from and None, or None and a blob
+        when the caller must upload the content and then fill in the blob's
+        key and set its done event.  While one thread uploads some content,
+        others with the same content wait for it to finish.  Listed keys
+        this sync has started writing are not copied from.
+        """
+        source = self.manifest.key_for(etag)
+        with self._blob_lock:
+            if source is not None and source not in self._written:
+                return (source, None)
+            blob = self._blobs.get(etag)
+            if blob is None:
+                blob = {'done': threading.Event(), 'key': None}
+                self._blobs[etag] = blob
+                return (None, blob)
+        blob['done'].wait()
+
+        return (blob['key'], None)
+
+    def copy_key(self, bucket, source, key, size, extra_args, etag):
+        """Copy source to key within bucket, replacing its metadata.
+
+        The copy only happens if source still has the ETag etag, as the
+        same sync may be overwriting it.  Large objects are copied in
+        CHUNK_SIZE parts, so the copy gets the same multipart ETag the
+        uploaded file would have.  Return false if source has changed.
+        """
+        copy_source = {'Bucket': bucket.name, 'Key': source}
+        extra_args = dict(extra_args, MetadataDirective='REPLACE',
+                          CopySourceIfMatch=etag)
+        try:
+            if size <= self.CHUNK_SIZE:
+                self.s3.meta.client.copy_object(Bucket=bucket.name, Key=key,
+                                                CopySource=copy_source,
+                                                **extra_args)
+            else:
+                self.s3.meta.client.copy(copy_source, bucket.name, key,
+                                         ExtraArgs=extra_args,
+                                         Config=self.transfer_config)
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('PreconditionFailed',
+                                                   '412'):
+                return False
+            raise
+
+        return True
+
+    def _uploaded_parts(self, bucket, key, upload_id):
+        """Get a dict of part number: etag of the parts S3 has stored.
+
+        Return None if the upload no longer exists.
+        """
+        paginator = self.s3.meta.client.get_paginator('list_parts')
+        parts = {}
+        try:
+            for page in paginator.paginate(Bucket=bucket.name, Key=key,
+                                           UploadId=upload_id):
+                for part in page.get('Parts', []):
+                    parts[part['PartNumber']] = part['ETag']
+        except ClientError as error:
+            if error.response['Error']['Code'] == 'NoSuchUpload':
+                return None
+            raise
+
+        return parts
+
+    def _upload_part(self, bucket, path, key, upload_id, number):
+        """Upload part number of the file at path and journal it."""
+        with open(path, 'rb') as f:
+            f.seek((number - 1) * self.CHUNK_SIZE)
+            data = f.read(self.CHUNK_SIZE)
+        response = self.s3.meta.client.upload_part(
+            Bucket=bucket.name, Key=key, UploadId=upload_id,
+            PartNumber=number, Body=data)
+        self.journal.record_part(upload_id, number, response['ETag'])
+
+        return response['ETag']
+
+    def upload_multipart(self, bucket, path, key, etag, extra_args):
+        """Upload path in CHUNK_SIZE parts, resuming a journaled upload.
+
+        An unfinished upload of the same content to key is carried on from
+        the parts both the journal and S3 have; otherwise a new multipart
+        upload is started.  Each part is journaled as soon as it is stored.
+        """
+        client = self.s3.meta.client
+        done = {}
+        found = self.journal.find_upload(key, etag, self.CHUNK_SIZE)
+        if found is not None:
+            (upload_id, journaled) = found
+            stored = self._uploaded_parts(bucket, key, upload_id)
+            if stored is None:
+                self.journal.record_upload_end(upload_id)
+                found = None
+            else:
+                done = {number: part_etag
+                        for (number, part_etag) in journaled.items()
+                        if stored.get(number) == part_etag}
+                print("Resuming upload of {} with {} part(s) done".format(
+                    key, len(done)))
+        if found is None:
+            upload_id = client.create_multipart_upload(
+                Bucket=bucket.name, Key=key, **extra_args)['UploadId']
+            self.journal.record_upload(key, etag, upload_id, self.CHUNK_SIZE)
+
+        size = os.path.getsize(path)
+        count = (size + self.CHUNK_SIZE - 1) // self.CHUNK_SIZE
+        with ThreadPoolExecutor(
+                max_workers=self.transfer_config.max_concurrency
+        ) as executor:
+            futures = {
+                executor.submit(self._upload_part, bucket, path, key,
+                                upload_id, number): number
+                for number in range(1, count + 1) if number not in done}
+            for future in as_completed(futures):
+                done[futures[future]] = future.result()
+
+        client.complete_multipart_upload(
+            Bucket=bucket.name, Key=key, UploadId=upload_id,
+            MultipartUpload={'Parts': [
+                {'PartNumber': number, 'ETag': done[number]}
+                for number in sorted(done)]})
+        self.journal.record_upload_end(upload_id)
+
+    def abort_stale_uploads(self, bucket, journal):
+        """Abort the unfinished multipart uploads recorded in journal."""
+        for (upload_id, upload) in list(journal.uploads.items()):
+            try:
+                self.s3.meta.client.abort_multipart_upload(
+                    Bucket=bucket.name, Key=upload['key'],
+                    UploadId=upload_id)
+            except ClientError as error:
+                if error.response['Error']['Code'] != 'NoSuchUpload':
+                    raise
+            journal.record_upload_end(upload_id)
+
+    def list_multipart_uploads(self, bucket_name):
+        """Get an iterator for the unfinished multipart uploads of a bucket."""
+        paginator = self.s3.meta.client.get_paginator(
+            'list_multipart_uploads')
+        for page in paginator.paginate(Bucket=bucket_name):
+            yield from page.get('Uploads', [])
+
+    def abort_uploads(self, bucket_name, older_than=None):
+        """Abort unfinished multipart uploads started before older_than.
+
+        older_than is a timezone aware datetime; None aborts them all.
+        Return the list of aborted uploads.
+        """
+        aborted = []
+        for upload in self.list_multipart_uploads(bucket_name):
+            if older_than is not None and upload['Initiated'] >= older_than:
+                continue
+            self.s3.meta.client.abort_multipart_upload(
+                Bucket=bucket_name, Key=upload['Key'],
+                UploadId=upload['UploadId'])
+            aborted.append(upload)
+
+        return aborted
+
+    def delete_batch(self, bucket, keys):
+        """Delete up to DELETE_BATCH_SIZE keys in one request.
+
+        Return a tuple of the deleted keys and a dict of key: error for
+        keys S3 refused to delete.
+        """
+        response = self.s3.meta.client.delete_objects(
+            Bucket=bucket.name,
+            Delete={
+                'Objects': [{'Key': key} for key in keys],
+                'Quiet': True
+            }
         )
+        # in quiet mode only the keys that failed are listed
+        errors = {
+            error['Key']: '{}: {}'.format(error['Code'], error['Message'])
+            for error in response.get('Errors', [])
+        }
+
+        return [key for key in keys if key not in errors], errors
+
+    def delete_keys(self, bucket, keys, summary, workers=1):
+        """Delete keys from bucket in concurrent DeleteObjects batches."""
+        keys = sorted(keys)
+        batches = [keys[i:i + self.DELETE_BATCH_SIZE]
+                   for i in range(0, len(keys), self.DELETE_BATCH_SIZE)]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self.delete_batch, bucket, batch): batch
+                       for batch in batches}
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    (deleted, errors) = future.result()
+                except ClientError as error:
+                    (deleted, errors) = ([], {key: error for key in batch})
+                for key in deleted:
+                    print("Deleting ", key,
+                          " from ", bucket.name, "- not on local"
+                          )
+                    summary.record('deleted', key)
+                for (key, error) in errors.items():
+                    print("Delete of {} failed: {}".format(key, error))
+                    summary.record_failure(key, error)
+
+    @staticmethod
+    def delta_options(path_filter, compressor, cache_policy):
+        """Get the sync options that shape uploads, for a git delta.
+
+        A delta is only valid if these are the same as last time.
+        """
+        options = {
+            'include': path_filter.include if path_filter else [],
+            'exclude': path_filter.exclude if path_filter else [],
+            'compress': compressor.encoding if compressor else None,
+            'cache_rules': cache_policy.rules if cache_policy else [],
+            'cache_default': cache_policy.default if cache_policy else None,
+        }
+
+        # normalized, so equal options always hash alike
+        return json.loads(json.dumps(options))
+
+    def git_changes(self, git, bucket, options, path_filter, summary):
+        """Get the files and stale keys for a git delta sync.
+
+        Return (None, None) when a full sync is needed.
+        """
+        changes = None
+        if git.open():
+            marker = git.read_marker(self.s3.meta.client, bucket.name)
+            changes = git.delta(marker, options, path_filter)
+        if changes is None:
+            summary.git_delta = "full sync, {}".format(git.reason)
+            return (None, None)
+
+        (changed, stale_keys) = changes
+        files = []
+        for key in sorted(changed):
+            path = os.path.join(git.root, *key.split('/'))
+            files.append((path, key, os.stat(path)))
+        summary.git_delta = "{} changed, {} removed since {}".format(
+            len(changed), len(stale_keys), git.base[:12])
 
-    def sync(self, pathname, bucket_name):
-        """Sync local folder to S3 bucket."""
+        return (files, stale_keys)
+
+    @staticmethod
+    def iter_files(pathname, path_filter=None):
+        """Yield (path, key, stat) for every file under pathname.
+
+        Files and directories rejected by path_filter are skipped.
+        """
+        return scan_tree(pathname, path_filter)
+
+    def sync(self, pathname, bucket_name, workers=1, etag_index=None,
+             delete=True, max_delete=None, list_shards=1,
+             hash_processes=0, path_filter=None, compressor=None,
+             cache_policy=None, journal=None, max_bandwidth=None,
+             git_delta=False, dedup=True):
+        """Sync local folder to S3 bucket.
+
+        Listing, walking, hashing and uploading run at the same time as a
+        SyncPipeline, with up to workers threads each hashing and uploading
+        files through one shared S3 client.  When etag_index is given, only
+        files whose stat changed since the last sync are re-hashed.  Keys
+        no longer present locally are deleted in batches, unless delete is
+        False or there are more than max_delete of them.  list_shards sets
+        how many prefixes of the bucket are listed at once.  hash_processes
+        > 0 hashes the parts of large files in a pool of that many
+        processes.  path_filter limits the sync - uploads and deletes - to
+        the keys it covers.  A Compressor given as compressor compresses
+        suitable files, which are uploaded with a Content-Encoding.  A
+        CachePolicy given as cache_policy sets each upload's Cache-Control.
+        A SyncJournal given as journal checkpoints uploads so an interrupted
+        sync can be resumed; it is emptied once a sync finishes cleanly.
+        max_bandwidth caps the bytes per second sent to S3.  With git_delta
+        only the files changed since the last git_delta sync's commit are
+        uploaded or deleted, without listing or walking, falling back to a
+        full sync when that can't be worked out.  With dedup, files whose
+        content is already in the bucket, or is uploaded once in this sync,
+        are created by server-side copies.  Return a SyncSummary of what
+        was done.
+        """
         bucket = self.s3.Bucket(bucket_name)
-        self.load_manifest(bucket)
-
-        root = Path(pathname).expanduser().resolve()
-
-        def handle_directory(target):
-            for path in target.iterdir():
-                if path.is_dir():
-                    handle_directory(path)
-                if path.is_file():
-                    self.upload_file(bucket, str(path.as_posix()),
-                                     str(path.relative_to(root).as_posix()))
-
-        handle_directory(root)
-        for (obj_key, obj_status) in bucket_chk.items():
-            # print(obj_key, obj_status)
-            if obj_status == "no":
-                # print("bucket = ", bucket)
-                # print("obj_key = ", obj_key)
-                print("Deleting ", obj_key,
-                      " from ", bucket.name, "- not on local"
-                      )
-                obj_del = self.s3.Object(bucket.name, obj_key)
-                obj_del.delete()
+        self.manifest = Manifest()
+        self.etag_index = etag_index
+        self.cache_policy = cache_policy
+        self.journal = journal
+        self.dedup = dedup
+        self._blobs = {}
+        self._written = set()
+        self.throttle.max_bandwidth = max_bandwidth
+        self.throttle.reset_stats()
+        summary = SyncSummary()
+        if hash_processes:
+            self.hash_pool = ProcessPoolExecutor(max_workers=hash_processes)
+
+        git = None
+        (files, stale_keys) = (None, None)
+        if git_delta:
+            git = GitDelta(pathname)
+            options = self.delta_options(path_filter, compressor,
+                                         cache_policy)
+            (files, stale_keys) = self.git_changes(git, bucket, options,
+                                                   path_filter, summary)
+
+        try:
+            SyncPipeline(self, bucket, summary, workers=workers,
+                         list_shards=list_shards,
+                         path_filter=path_filter,
+                         compressor=compressor).run(
+                             pathname, delete=delete, max_delete=max_delete,
+                             files=files, stale_keys=stale_keys)
+        finally:
+            if self.hash_pool is not None:
+                self.hash_pool.shutdown()
+                self.hash_pool = None
+            self.cache_policy = None
+            self.journal = None
+            self.dedup = False
+            self._blobs = {}
+            self._written = set()
+        if git is not None and git.head and not summary.failed and \
+                summary.delete_held is None:
+            # a held back delete must still be found by the next delta
+            git.write_marker(self.s3.meta.client, bucket.name, options)
+        summary.manifest_keys = len(self.manifest)
+        summary.manifest_bytes = self.manifest.memory_usage()
+        if compressor is not None:
+            compressor.prune()
+            summary.compressed = (compressor.compressed, compressor.reused)
+
+        if etag_index is not None:
+            if files is None:
+                etag_index.prune()
+            else:
+                # a delta only looked up the changed files
+                etag_index.prune(set(etag_index.entries) - set(stale_keys))
+            etag_index.save()
+            summary.etag_index_hits = etag_index.hits
+            summary.etag_index_misses = etag_index.misses
+            self.etag_index = None
+        if journal is not None and not summary.failed:
+            # uploads left over from interrupted runs for files that have
+            # changed since would otherwise be stored (and billed) forever
+            self.abort_stale_uploads(bucket, journal)
+            journal.reset()
+        summary.throttle = self.throttle.report()
+
+        return summary
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for per-path Cache-Control policies."""
+
+from fnmatch import fnmatchcase
+import json
+
+# for assets whose name changes whenever their content does
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+class CachePolicy:
+    """Pick the Cache-Control header for each key from a rules file.
+
+    The rules file is JSON like:
+
+        {
+            "rules": [
+                {"pattern": "*.html", "cache_control": "no-cache"},
+                {"pattern": "images/*", "cache_control": "max-age=86400"}
+            ],
+            "default": "public, max-age=3600"
+        }
+
+    Patterns are globs matched against the whole key or its file name; the
+    first matching rule wins.  Keys in immutable_keys - fingerprinted
+    assets - always get IMMUTABLE.
+    """
+
+    def __init__(self, rules=(), default=None):
+        """Create a CachePolicy object from (pattern, header) pairs."""
+        self.rules = list(rules)
+        self.default = default
+        self.immutable_keys = set()
+
+    @classmethod
+    def from_file(cls, path):
+        """Load a CachePolicy from a JSON rules file."""
+        with open(path, 'r') as f:
+            data = json.load(f)
+        rules = [(rule['pattern'], rule['cache_control'])
+                 for rule in data.get('rules', [])]
+
+        return cls(rules, data.get('default'))
+
+    def cache_control(self, key):
+        """Get the Cache-Control header for key, or None for no header."""
+        if key in self.immutable_keys:
+            return IMMUTABLE
+        name = key.rpartition('/')[2]
+        for (pattern, header) in self.rules:
+            if fnmatchcase(key, pattern) or fnmatchcase(name, pattern):
+                return header
+
+        return self.default
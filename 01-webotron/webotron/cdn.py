@@ -2,23 +2,107 @@
 
 """Classes for CDN Distributions."""
 
+import time
 import uuid
 
+from webotron import util
+from webotron.waiter import DeployWaiter
+
+
+def summarize(dist):
+    """Get the parts of a dist from a listing or create_distribution kept.
+
+    Only JSON serializable parts are kept, so summaries can be cached.
+    """
+    aliases = dist['Aliases'] if 'Aliases' in dist else \
+        dist['DistributionConfig']['Aliases']
+
+    return {
+        'Id': dist['Id'],
+        'ARN': dist['ARN'],
+        'Status': dist['Status'],
+        'DomainName': dist['DomainName'],
+        'Aliases': {'Quantity': aliases['Quantity'],
+                    'Items': aliases.get('Items', [])},
+    }
+
+
+class AliasIndex:
+    """Look up dists by the aliases they serve.
+
+    Exact aliases and the parents of wildcard aliases are kept in dicts.
+    An exact alias wins, then the wildcard of the nearest parent, as with
+    CloudFront itself: *.example.com serves www.example.com and
+    a.www.example.com unless something more specific does.
+    """
+
+    def __init__(self):
+        """Create an empty AliasIndex object."""
+        self.dists = []
+        self.exact = {}
+        self.wildcard = {}
+
+    def add(self, dist):
+        """Index a dist summary under each of its aliases."""
+        self.dists.append(dist)
+        for alias in dist['Aliases']['Items']:
+            alias = alias.lower()
+            if alias.startswith('*.'):
+                self.wildcard[alias[2:]] = dist
+            else:
+                self.exact[alias] = dist
+
+    def match(self, domain_name, wildcards=True):
+        """Get the dist serving domain_name, or None.
+
+        Without wildcards only a dist with domain_name itself as an alias
+        matches.
+        """
+        domain_name = domain_name.lower().rstrip('.')
+        dist = self.exact.get(domain_name)
+        while wildcards and dist is None and '.' in domain_name:
+            domain_name = domain_name.partition('.')[2]
+            dist = self.wildcard.get(domain_name)
+
+        return dist
+
 
 class DistributionManager:
-    """Manage a CDN Distribution."""
+    """Manage a CDN Distribution.
+
+    Dists are listed once, from a local cache shared by later commands
+    when it is recent enough, and indexed by alias in an AliasIndex.
+    """
+
+    CACHE_TTL = 3600
 
     def __init__(self, session):
         """Manage a CDN Distribution."""
         self.session = session
         self.client = self.session.client('cloudfront')
+        self.index = None
+        # whether the index came from the cache, and when it was listed
+        self.index_cached = False
+        self.fetched = None
+
+    def load_index(self, refresh=False):
+        """Index the dists by alias, from the cache unless refresh is set.
+
+        The cache is used for up to CACHE_TTL seconds.  Return the
+        AliasIndex, which stays loaded for the life of the
+        DistributionManager.
+        """
+        cache = None if refresh else util.read_account_cache(
+            self.session, 'cloudfront-dists', self.CACHE_TTL)
+        self.index_cached = cache is not None
+        self.index = AliasIndex()
+        if cache is not None:
+            (dists, self.fetched) = cache
+            for dist in dists:
+                self.index.add(dist)
+            return self.index
 
-    def find_matching_dist(self, domain_name):
-        """Find a dist matching domain_name."""
         paginator = self.client.get_paginator('list_distributions')
-        # paginate thru List of distribution items and within that the items
-        # and alias items for those distrbution items and check if it matches
-        # the domain_name being sought
         # Here is an excerpt for the DistributionList Structure:
         #    'DistributionList': {
         #        'Items': [
@@ -34,13 +118,36 @@ class DistributionManager:
         #                        'string',
         #                    ]
         #                },
+        # Items is left out of Aliases when there are none
+        self.fetched = time.time()
         for page in paginator.paginate():
             for dist in page['DistributionList'].get('Items', []):
-                for alias in dist['Aliases']['Items']:
-                    if alias == domain_name:
-                        return dist
+                self.index.add(summarize(dist))
+        util.write_account_cache(self.session, 'cloudfront-dists',
+                                 self.index.dists, self.fetched)
 
-        return None
+        return self.index
+
+    def find_matching_dists(self, domain_names, wildcards=False):
+        """Find the dist serving each domain, or None.
+
+        Return a dict of domain name to a dist summary of its Id, ARN,
+        Status, DomainName and Aliases.  Only dists with the domain
+        itself as an alias match unless wildcards is set.  Domains with
+        no dist in a cached index are looked up again in a fresh one, in
+        case their dist was created since.
+        """
+        if self.index is None:
+            self.load_index()
+
+        return util.resolve_with_refresh(
+            domain_names, lambda name: self.index.match(name, wildcards),
+            self.index_cached, lambda: self.load_index(refresh=True))
+
+    def find_matching_dist(self, domain_name, wildcards=False):
+        """Find a dist matching domain_name."""
+        return self.find_matching_dists([domain_name],
+                                        wildcards)[domain_name]
 
     def create_dist(self, domain_name, cert):
         """Create a dist for domain_name using cert."""
@@ -82,9 +189,12 @@ class DistributionManager:
                         'QueryString': False,
                         'QueryStringCacheKeys': {'Quantity': 0}
                     },
-                    # DefaulitTTL = 24 hours and Min is 1 hour
+                    # DefaulitTTL = 24 hours, used when an object has no
+                    # Cache-Control header.  MinTTL is 0 so the headers
+                    # set by sync --cache-rules (e.g. no-cache for html)
+                    # are honored.
                     'DefaultTTL': 86400,
-                    'MinTTL': 3600
+                    'MinTTL': 0
                 },
                 'ViewerCertificate': {
                     'ACMCertificateArn': cert['CertificateArn'],
@@ -94,12 +204,51 @@ class DistributionManager:
             }
         )
 
-        return result['Distribution']
+        dist = result['Distribution']
+        if self.index is not None:
+            self.index.add(summarize(dist))
+            util.write_account_cache(self.session, 'cloudfront-dists',
+                                     self.index.dists, self.fetched)
+
+        return dist
+
+    def waiter(self):
+        """Get a DeployWaiter for tracking many dists and invalidations."""
+        return DeployWaiter(self.client)
+
+    def await_deploy(self, dist, max_wait=1800):
+        """Wait for dist to be deployed.
+
+        Return true if it was deployed within max_wait seconds.
+        """
+        waiter = self.waiter()
+        waiter.track_distribution(dist['Id'])
+
+        return waiter.wait(max_wait)[dist['Id']] is not None
+
+    def create_invalidation(self, dist_id, paths):
+        """Invalidate paths on the dist with one batched request."""
+        result = self.client.create_invalidation(
+            DistributionId=dist_id,
+            InvalidationBatch={
+                'Paths': {
+                    'Quantity': len(paths),
+                    'Items': list(paths)
+                },
+                'CallerReference': str(uuid.uuid4())
+            }
+        )
+
+        return result['Invalidation']
+
+    def await_invalidation(self, dist_id, invalidation, max_wait=1800):
+        """Wait for an invalidation to complete, backing off between polls.
+
+        Return true if it completed within max_wait seconds.
+        """
+        if invalidation['Status'] == 'Completed':
+            return True
+        waiter = self.waiter()
+        waiter.track_invalidation(dist_id, invalidation['Id'])
 
-    def await_deploy(self, dist):
-        """Wait for dist to be deployed."""
-        waiter = self.client.get_waiter('distbution_deployed')
-        waiter.wait(Id=dist['Id'], WaiterConfig={
-            'Delay': 30,
-            'MaxAttempts': 50
-        })
+        return waiter.wait(max_wait)[invalidation['Id']] is not None
@@ -2,51 +2,183 @@
 
 """Classes for ACM Certificates."""
 
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from botocore.config import Config
+
+from webotron import util
+
+
+def name_matches(name, domain_name):
+    """Return true if the certificate name name covers domain_name.
+
+    A wildcard name such as *.example.com covers exactly one more label,
+    as it does for TLS: www.example.com but not example.com or
+    a.www.example.com.
+    """
+    name = name.lower()
+    domain_name = domain_name.lower().rstrip('.')
+    if name.startswith('*.'):
+        (_, sep, parent) = domain_name.partition('.')
+        return bool(sep) and parent == name[2:]
+
+    return name == domain_name
+
+
+class CertIndex:
+    """Look up certificates by the names they cover.
+
+    Exact names and the parents of wildcard names are kept in dicts, so a
+    lookup costs two dict probes however many certificates there are.
+    Certificates are preferred in the order they were added, with an
+    exact name winning over a wildcard.
+    """
+
+    def __init__(self):
+        """Create an empty CertIndex object."""
+        self.exact = {}
+        self.wildcard = {}
+
+    def add(self, cert, names):
+        """Index cert under each of its names."""
+        for name in names:
+            name = name.lower()
+            if name.startswith('*.'):
+                self.wildcard.setdefault(name[2:], cert)
+            else:
+                self.exact.setdefault(name, cert)
+
+    def match(self, domain_name):
+        """Get the certificate covering domain_name, or None."""
+        domain_name = domain_name.lower().rstrip('.')
+        cert = self.exact.get(domain_name)
+        if cert is None:
+            (_, sep, parent) = domain_name.partition('.')
+            cert = self.wildcard.get(parent) if sep else None
+
+        return cert
+
 
 class CertificateManager:
-    """Manage an ACM Certificate."""
+    """Manage an ACM Certificate.
+
+    The subject alternative names of certificates are fetched in parallel
+    and cached on disk, per account, by ARN for CACHE_TTL seconds, as they
+    never change for a given certificate.  The issued certificates are
+    listed once per CertificateManager and indexed, so finding
+    certificates for any number of domains costs one scan in total.
+    """
+
+    CACHE_TTL = 86400
+    # parallel DescribeCertificate calls; ACM throttles beyond about 10/s,
+    # which the client's retries absorb
+    MAX_WORKERS = 8
 
     def __init__(self, session):
         """Manage an ACM Certificate."""
         self.session = session
-        self.client = self.session.client('acm', region_name='us-east-1')
+        self.client = self.session.client(
+            'acm', region_name='us-east-1', config=Config(
+                max_pool_connections=self.MAX_WORKERS,
+                retries={'mode': 'standard', 'max_attempts': 10}
+            ))
+        self.index = None
+        # arn: {'names': [...], 'fetched': epoch seconds}
+        self._names = None
+        self._lock = threading.Lock()
+
+    def _load_cache(self):
+        """Read the cached certificate names, dropping expired ones."""
+        cache = util.read_account_cache(self.session, 'acm-names')
+        entries = cache[0] if cache is not None else {}
+        oldest = time.time() - self.CACHE_TTL
+        try:
+            self._names = {arn: entry for (arn, entry) in entries.items()
+                           if entry.get('fetched', 0) >= oldest}
+        except AttributeError:
+            self._names = {}
+
+    def _save_cache(self, arns):
+        """Write the cached names of the certificates in arns."""
+        with self._lock:
+            entries = {arn: entry for (arn, entry) in self._names.items()
+                       if arn in arns}
+        util.write_account_cache(self.session, 'acm-names', entries)
+
+    def cert_names(self, cert_arn):
+        """Get the subject alternative names of a certificate."""
+        if self._names is None:
+            self._load_cache()
+        entry = self._names.get(cert_arn)
+        if entry is None:
+            cert_details = self.client.describe_certificate(
+                CertificateArn=cert_arn
+            )
+            # a list of values, e.g.
+            # ['themdbelchers.com', '*.themdbelchers.com']
+            entry = {
+                'names': cert_details['Certificate'].get(
+                    'SubjectAlternativeNames', []),
+                'fetched': time.time(),
+            }
+            with self._lock:
+                self._names[cert_arn] = entry
+
+        return entry['names']
 
     def cert_matches(self, cert_arn, domain_name):
         """Check if certificate matches."""
-        cert_details = self.client.describe_certificate(
-                CertificateArn=cert_arn
-        )
-        # note - the following statement returns a list of values,
-        # (e.g. ['themdbelchers.com', '*.themdbelchers.com'] and later
-        # each is referred to as 'name'
-        alt_names = cert_details['Certificate']['SubjectAlternativeNames']
-        for name in alt_names:
-            if name == domain_name:
-                # print("path1")
-                # print("name = ", name)
-                # print("domain_name = ", domain_name)
-                return True
-            # if name in certificate name list = * & domain_name ends with the
-            # same string as the end of name then consider it a wildcard match
-            if name[0] == '*' and domain_name.endswith(name[1:]):
-                # print("path2")
-                # print("name = ", name)
-                # print("domain_name = ", domain_name)
-                return True
-            # print("path3")
-            # print("name = ", name)
-            # print("domain_name = ", domain_name)
-        return False
+        return any(name_matches(name, domain_name)
+                   for name in self.cert_names(cert_arn))
 
-    def find_matching_cert(self, domain_name):
-        """Find matching certificate."""
+    def load_index(self, refresh=False):
+        """List the issued certificates and index them by name.
+
+        Names come from the listing when it has them all, otherwise from
+        the cache or DescribeCertificate.  refresh ignores the cache.
+        """
+        if refresh:
+            self._names = {}
+        elif self._names is None:
+            self._load_cache()
         paginator = self.client.get_paginator('list_certificates')
-# paginate thru only issued certs to find a match against our
-# domain_name for bucket - either exact: themdbelchers.com
-#   or wildcard: #.themdbelchers.com like kittentest.themdbelchers.com
+        certs = []
         for page in paginator.paginate(CertificateStatuses=['ISSUED']):
-            for cert in page['CertificateSummaryList']:
-                if self.cert_matches(cert['CertificateArn'], domain_name):
-                    return cert
+            certs.extend(page['CertificateSummaryList'])
 
-        return None
+        fetch = []
+        for cert in certs:
+            arn = cert['CertificateArn']
+            names = cert.get('SubjectAlternativeNameSummaries')
+            if names and \
+                    not cert.get('HasAdditionalSubjectAlternativeNames'):
+                self._names[arn] = {'names': names, 'fetched': time.time()}
+            elif arn not in self._names:
+                fetch.append(arn)
+        if fetch:
+            with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as pool:
+                list(pool.map(self.cert_names, fetch))
+
+        index = CertIndex()
+        for cert in certs:
+            index.add(cert, self.cert_names(cert['CertificateArn']))
+        self._save_cache({cert['CertificateArn'] for cert in certs})
+        self.index = index
+
+        return index
+
+    def find_matching_certs(self, domain_names):
+        """Find the matching certificate of each domain, or None.
+
+        Return a dict of domain name to certificate summary.
+        """
+        index = self.index or self.load_index()
+
+        return {domain_name: index.match(domain_name)
+                for domain_name in domain_names}
+
+    def find_matching_cert(self, domain_name):
+        """Find matching certificate."""
+        return self.find_matching_certs([domain_name])[domain_name]
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for precompressing site assets before upload."""
+
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import os
+import threading
+import time
+
+from webotron import util
+from webotron.etag import compute_etag
+
+try:
+    import brotli
+except ImportError:  # brotli is optional - only gzip is then available
+    brotli = None
+
+# MIME types worth compressing, besides text/*
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/manifest+json',
+    'application/rss+xml',
+    'application/wasm',
+    'application/xhtml+xml',
+    'application/xml',
+    'font/otf',
+    'font/ttf',
+    'image/svg+xml',
+    'image/x-icon',
+    'image/vnd.microsoft.icon',
+}
+ENCODINGS = ['gzip', 'br']
+
+
+def available_encodings():
+    """List the encodings that can be used here."""
+    return [encoding for encoding in ENCODINGS
+            if encoding != 'br' or brotli is not None]
+
+
+def compress_file(source, target, encoding):
+    """Write the encoding compressed contents of source to target.
+
+    Output only depends on the input bytes - gzip gets no file name or
+    timestamp - so the same source always gives the same ETag.
+    """
+    with open(source, 'rb') as f:
+        data = f.read()
+    tmp_target = target + '.tmp{}'.format(os.getpid())
+    with open(tmp_target, 'wb') as f:
+        if encoding == 'br':
+            f.write(brotli.compress(data))
+        else:
+            with gzip.GzipFile(filename='', mode='wb', compresslevel=9,
+                               fileobj=f, mtime=0) as gz:
+                gz.write(data)
+    os.replace(tmp_target, target)
+
+
+class Compressor:
+    """Compress files for upload with a Content-Encoding.
+
+    Compressed output is cached in the webotron cache dir under the etag
+    of its source, so a file is only compressed again once it changes.
+    """
+
+    # smaller files gain too little to be worth compressing
+    MIN_SIZE = 1024
+    # cache entries unused for this long are removed by prune
+    MAX_AGE = 30 * 24 * 3600
+
+    def __init__(self, encoding='gzip', processes=None, chunk_size=None):
+        """Create a Compressor object using a pool of processes."""
+        if encoding not in available_encodings():
+            raise ValueError("Unsupported encoding {}".format(encoding))
+        self.encoding = encoding
+        self.chunk_size = chunk_size
+        self.cache_dir = util.get_cache_dir() / 'compressed'
+        self.cache_dir.mkdir(exist_ok=True)
+        self.pool = ProcessPoolExecutor(max_workers=processes)
+        self._lock = threading.Lock()
+        self.compressed = 0
+        self.reused = 0
+
+    @staticmethod
+    def compressible(content_type):
+        """Return true if content of content_type is worth compressing."""
+        return content_type.startswith('text/') or \
+            content_type in COMPRESSIBLE_TYPES
+
+    def compress(self, path, etag, content_type):
+        """Get the file to upload for path, whose etag is etag.
+
+        Return a tuple of (path, etag, encoding) - the original path, etag
+        and None when the file isn't worth compressing.
+        """
+        if not self.compressible(content_type) or \
+                os.path.getsize(path) < self.MIN_SIZE:
+            return (path, etag, None)
+
+        target = str(self.cache_dir / '{}.{}'.format(
+            etag.strip('"'), self.encoding))
+        if os.path.exists(target):
+            os.utime(target)
+            counter = 'reused'
+        else:
+            self.pool.submit(compress_file, path, target,
+                             self.encoding).result()
+            counter = 'compressed'
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+        if os.path.getsize(target) >= os.path.getsize(path):
+            return (path, etag, None)
+
+        return (target, compute_etag(target, self.chunk_size), self.encoding)
+
+    def prune(self):
+        """Remove cached outputs that haven't been used for MAX_AGE."""
+        cutoff = time.time() - self.MAX_AGE
+        for entry in os.scandir(str(self.cache_dir)):
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+
+    def shutdown(self):
+        """Shut down the process pool."""
+        self.pool.shutdown()
@@ -2,32 +2,128 @@
 
 """Classes for Route 53 domains."""
 
+from concurrent.futures import ThreadPoolExecutor
+import time
 import uuid
 
+from webotron import util
+
+
+class ZoneIndex:
+    """Find the most specific hosted zone of a domain.
+
+    Zones are kept in a trie keyed by their labels in reverse order - com,
+    then example - so a lookup walks one node per label of the domain and
+    the deepest zone passed is the longest label-aligned match:
+    www.example.com finds example.com but never xexample.com.  Public
+    zones win over private zones of the same name.
+    """
+
+    def __init__(self):
+        """Create an empty ZoneIndex object."""
+        # label: child node; the zone itself is kept under None
+        self.root = {}
+
+    @staticmethod
+    def _labels(name):
+        return reversed(name.lower().rstrip('.').split('.'))
+
+    def add(self, zone):
+        """Add a hosted zone from ListHostedZones."""
+        node = self.root
+        for label in self._labels(zone['Name']):
+            node = node.setdefault(label, {})
+        current = node.get(None)
+        if current is None or (
+                current.get('Config', {}).get('PrivateZone') and
+                not zone.get('Config', {}).get('PrivateZone')):
+            node[None] = zone
+
+    def resolve(self, domain_name):
+        """Get the most specific zone domain_name is in, or None."""
+        node = self.root
+        zone = None
+        for label in self._labels(domain_name):
+            node = node.get(label)
+            if node is None:
+                break
+            zone = node.get(None, zone)
+
+        return zone
+
 
 class DomainManager:
-    """Manage a Route 53 domain."""
+    """Manage a Route 53 domain.
+
+    The hosted zone list is loaded once, from a local cache shared by
+    later commands when it is recent enough, and indexed in a ZoneIndex.
+    """
+
+    CACHE_TTL = 3600
+    # an UPSERT counts twice against the 1000 changes a batch may hold
+    MAX_BATCH_CHANGES = 500
+    POLL_DELAY = 2
+    MAX_POLL_DELAY = 30
+    # GetChange is limited to 5 requests a second per account
+    MAX_POLLERS = 4
 
     def __init__(self, session):
         """Create DomainManager object."""
         self.session = session
         self.client = self.session.client('route53')
+        self.index = None
+        # whether the index came from the cache, and when it was listed
+        self.zones_cached = False
+        self.fetched = None
+        self._zones = []
+
+    def load_zones(self, refresh=False):
+        """Index the hosted zones, from the cache unless refresh is set.
+
+        The cache is used for up to CACHE_TTL seconds.  Return the
+        ZoneIndex, which stays loaded for the life of the DomainManager.
+        """
+        cache = None if refresh else util.read_account_cache(
+            self.session, 'route53-zones', self.CACHE_TTL)
+        self.zones_cached = cache is not None
+        if cache is None:
+            zones = []
+            paginator = self.client.get_paginator('list_hosted_zones')
+            for page in paginator.paginate():
+                zones.extend(page['HostedZones'])
+            self.fetched = time.time()
+            util.write_account_cache(self.session, 'route53-zones', zones,
+                                     self.fetched)
+        else:
+            (zones, self.fetched) = cache
+
+        self.index = ZoneIndex()
+        for zone in zones:
+            self.index.add(zone)
+        self._zones = zones
+
+        return self.index
 
 # possible domain values - note subdomain in second case:
 #   kittentest.themdbelchers.com
 #   subdomain.kittentest.themdbelchers.com
+    def find_hosted_zones(self, domain_names):
+        """Find the most specific hosted zone of each domain, or None.
+
+        Return a dict of domain name to zone.  Domains with no zone in a
+        cached zone list are looked up again in a fresh one, in case their
+        zone was created since.
+        """
+        if self.index is None:
+            self.load_zones()
+
+        return util.resolve_with_refresh(
+            domain_names, lambda name: self.index.resolve(name),
+            self.zones_cached, lambda: self.load_zones(refresh=True))
+
     def find_hosted_zone(self, domain_name):
         """Find Hosted Zone."""
-        paginator = self.client.get_paginator('list_hosted_zones')
-        for page in paginator.paginate():
-            for zone in page['HostedZones']:
-                # test if domain name ends with the zone name,
-                # except for the final period
-                if domain_name.endswith(zone['Name'][:-1]):
-                    return zone
-        # if no match of the zone and return of Zone doesn't
-        # occur above, then return with find_hosted_zone
-        return None
+        return self.find_hosted_zones([domain_name])[domain_name]
 
 # desired values:
 #   domain_name = 'subdomain.kittentest.themdbelchers.com
@@ -35,55 +131,137 @@ class DomainManager:
     def create_hosted_zone(self, domain_name):
         """Create Hosted Zone when none present."""
         zone_name = '.'.join(domain_name.split('.')[-2:]) + '.'
-        return self.client.create_hosted_zone(
+        response = self.client.create_hosted_zone(
             Name=zone_name,
             CallerReference=str(uuid.uuid4())
         )
+        if self.index is not None:
+            self.index.add(response['HostedZone'])
+            self._zones.append(response['HostedZone'])
+            util.write_account_cache(self.session, 'route53-zones',
+                                     self._zones, self.fetched)
 
-    def create_s3_domain_record(self, zone, domain_name, endpoint):
-        """Create S3 Domain Record when not present."""
+        return response
+
+    @staticmethod
+    def s3_record(domain_name, endpoint):
+        """Build an alias A record pointing domain_name at an S3 website."""
+        return {
+            'Name': domain_name,
+            'Type': 'A',
+            'AliasTarget': {
+                'HostedZoneId': endpoint.zone,
+                'DNSName': endpoint.host,
+                'EvaluateTargetHealth': False
+            }
+        }
+
+    @staticmethod
+    def cf_record(domain_name, cf_domain):
+        """Build an alias A record pointing domain_name at CloudFront."""
+        return {
+            'Name': domain_name,
+            'Type': 'A',
+            'AliasTarget': {
+                # Note that for CloudFront, the hosted zone
+                # id will always be the value below - Alias
+                # resource record sets for Cloudfront can't be
+                # created in a private zone.
+                'HostedZoneId': 'Z2FDTNDATAQYW2',
+                'DNSName': cf_domain,
+                'EvaluateTargetHealth': False
+            }
+        }
+
+    def upsert(self, zone, records):
+        """UPSERT the record sets records into zone in one change batch."""
         return self.client.change_resource_record_sets(
             HostedZoneId=zone['Id'],
             ChangeBatch={
                 'Comment': 'Creatd by webotron',
-                'Changes': [{
-                        'Action': 'UPSERT',
-                        'ResourceRecordSet': {
-                            'Name': domain_name,
-                            'Type': 'A',
-                            'AliasTarget': {
-                                'HostedZoneId': endpoint.zone,
-                                'DNSName': endpoint.host,
-                                'EvaluateTargetHealth': False
-                            }
-                        }
-                    }
-                ]
+                'Changes': [{'Action': 'UPSERT', 'ResourceRecordSet': record}
+                            for record in records]
             }
         )
 
+    def create_s3_domain_record(self, zone, domain_name, endpoint):
+        """Create S3 Domain Record when not present."""
+        return self.upsert(zone, [self.s3_record(domain_name, endpoint)])
+
     def create_cf_domain_record(self, zone, domain_name, cf_domain):
         """Create Cloudfront Domain Record when not present."""
-        return self.client.change_resource_record_sets(
-            HostedZoneId=zone['Id'],
-            ChangeBatch={
-                'Comment': 'Creatd by webotron',
-                'Changes': [{
-                        'Action': 'UPSERT',
-                        'ResourceRecordSet': {
-                            'Name': domain_name,
-                            'Type': 'A',
-                            'AliasTarget': {
-                                # Note that for CloudFront, the hosted zone
-                                # id will always be the value below - Alias
-                                # resource record sets for Cloudfront can't be
-                                # created in a private zone.
-                                'HostedZoneId': 'Z2FDTNDATAQYW2',
-                                'DNSName': cf_domain,
-                                'EvaluateTargetHealth': False
-                            }
-                        }
-                    }
-                ]
-            }
-        )
+        return self.upsert(zone, [self.cf_record(domain_name, cf_domain)])
+
+    def upsert_records(self, records):
+        """UPSERT many record sets with as few change batches as possible.
+
+        records are record sets such as s3_record and cf_record build.
+        They are grouped by hosted zone and sent MAX_BATCH_CHANGES at a
+        time.  Return a tuple of the submitted changes - dicts of the
+        change Id, the zone and the record names in it - and the names
+        that have no hosted zone.
+        """
+        if not records:
+            return ([], [])
+        # a batch may only change a record set once; the last one wins
+        records = list({(record['Name'], record['Type']): record
+                        for record in records}.values())
+        zones = self.find_hosted_zones(
+            {record['Name'] for record in records})
+        by_zone = {}
+        missing = []
+        for record in records:
+            zone = zones[record['Name']]
+            if zone is None:
+                missing.append(record['Name'])
+            else:
+                by_zone.setdefault(zone['Id'], (zone, []))[1].append(record)
+
+        changes = []
+        for (zone, zone_records) in by_zone.values():
+            for start in range(0, len(zone_records), self.MAX_BATCH_CHANGES):
+                batch = zone_records[start:start + self.MAX_BATCH_CHANGES]
+                response = self.upsert(zone, batch)
+                changes.append({
+                    'Id': response['ChangeInfo']['Id'],
+                    'Zone': zone,
+                    'Names': [record['Name'] for record in batch],
+                    'submitted': time.monotonic(),
+                })
+
+        return (changes, missing)
+
+    def await_changes(self, changes, timeout=600):
+        """Wait for changes from upsert_records to be INSYNC.
+
+        Every pending change is polled at once each round, with the delay
+        between rounds backing off from POLL_DELAY to MAX_POLL_DELAY.
+        Return a dict of record name to the seconds from submitting its
+        change to seeing it INSYNC, or None if it wasn't by timeout.
+        """
+        latencies = {name: None for change in changes
+                     for name in change['Names']}
+        pending = list(changes)
+        deadline = time.monotonic() + timeout
+        delay = self.POLL_DELAY
+        with ThreadPoolExecutor(max_workers=self.MAX_POLLERS) as executor:
+            while pending:
+                statuses = list(executor.map(
+                    lambda change: self.client.get_change(
+                        Id=change['Id'])['ChangeInfo']['Status'],
+                    pending))
+                now = time.monotonic()
+                still_pending = []
+                for (change, status) in zip(pending, statuses):
+                    if status == 'INSYNC':
+                        for name in change['Names']:
+                            latencies[name] = now - change['submitted']
+                    else:
+                        still_pending.append(change)
+                pending = still_pending
+                if not pending or now >= deadline:
+                    break
+                time.sleep(min(delay, max(0, deadline - now)))
+                delay = min(delay * 2, self.MAX_POLL_DELAY)
+
+        return latencies
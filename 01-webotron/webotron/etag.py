@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""Provide streaming computation of S3 style ETags for local files."""
+
+import binascii
+from hashlib import md5
+import os
+
+MB = 1024 * 1024
+# part sizes used by the aws cli, the console, older webotron versions and
+# other common tools, most likely first
+COMMON_PART_SIZES = [8 * MB, 16 * MB, 5 * MB, 15 * MB, 32 * MB, 64 * MB,
+                     100 * MB, 128 * MB, 256 * MB, 512 * MB]
+# largest read when hashing, whatever the part size
+BUFFER_SIZE = 8 * MB
+# most part sizes tried when guessing how a foreign object was uploaded
+MAX_CANDIDATES = 4
+# files with fewer parts than this are not worth shipping to a pool
+PARALLEL_MIN_PARTS = 4
+# parts hashed per pool task, so each task reads a decent sized range
+PARTS_PER_TASK = 8
+
+
+def hash_parts(path, offset, count, chunk_size):
+    """Return the md5 digests of count parts of path starting at offset.
+
+    The range is read through one reusable buffer of at most BUFFER_SIZE
+    bytes, so memory use doesn't grow with chunk_size and no new bytes
+    objects are created per read.
+    """
+    digests = []
+    with open(path, 'rb') as f:
+        # small files don't need a whole buffer
+        remaining = os.fstat(f.fileno()).st_size - offset
+        view = memoryview(bytearray(
+            max(1, min(BUFFER_SIZE, chunk_size, remaining))))
+        f.seek(offset)
+        for _ in range(count):
+            digest = md5()
+            filled = 0
+            while filled < chunk_size:
+                read = f.readinto(view[:min(len(view), chunk_size - filled)])
+                if not read:
+                    break
+                digest.update(view[:read])
+                filled += read
+            if not filled:
+                break
+            digests.append(digest.digest())
+            if filled < chunk_size:
+                break
+
+    return digests
+
+
+def compute_etag(path, chunk_size, pool=None):
+    """Compute the ETag S3 gives path when uploaded in chunk_size parts.
+
+    An empty file gets the md5 of no data, as S3 reports for an empty
+    object.  With a concurrent.futures pool, large files have their parts
+    hashed by the pool in parallel.
+    """
+    size = os.path.getsize(path)
+    part_count = -(-size // chunk_size)
+
+    if pool is None or part_count < PARALLEL_MIN_PARTS:
+        digests = hash_parts(path, 0, part_count, chunk_size)
+    else:
+        futures = [pool.submit(hash_parts, path, first * chunk_size,
+                               min(PARTS_PER_TASK, part_count - first),
+                               chunk_size)
+                   for first in range(0, part_count, PARTS_PER_TASK)]
+        digests = [digest for future in futures
+                   for digest in future.result()]
+
+    if not digests:
+        return '"{}"'.format(md5().hexdigest())
+    if len(digests) == 1:
+        return '"{}"'.format(digests[0].hex())
+
+    return '"{}-{}"'.format(md5(b''.join(digests)).hexdigest(),
+                            len(digests))
+
+
+def one_part_etag(etag):
+    """Turn a single part ETag into the ETag of a one part multipart upload.
+
+    S3 gives a file uploaded as a single part multipart upload the ETag
+    md5(md5(data))-1 rather than md5(data).
+    """
+    digest = binascii.unhexlify(etag.strip('"'))
+
+    return '"{}-1"'.format(md5(digest).hexdigest())
+
+
+def candidate_part_sizes(size, parts):
+    """Guess the part sizes that split size bytes into parts parts.
+
+    parts is the -N suffix of a remote ETag, 0 if it had none.  Common
+    part sizes are preferred, then whole MiB sizes in the possible range.
+    At most MAX_CANDIDATES sizes are returned.
+    """
+    if parts <= 1:
+        # a single part - or a one part multipart upload - covers the
+        # whole file, whatever part size the uploader used
+        return [size] if size else []
+
+    # ceil(size / part_size) == parts
+    smallest = -(-size // parts)
+    largest = -(-size // (parts - 1)) - 1
+    if smallest > largest:
+        return []
+
+    candidates = [part_size for part_size in COMMON_PART_SIZES
+                  if smallest <= part_size <= largest]
+    part_size = -(-smallest // MB) * MB
+    while part_size <= largest and len(candidates) < MAX_CANDIDATES:
+        if part_size not in candidates:
+            candidates.append(part_size)
+        part_size += MB
+
+    return candidates[:MAX_CANDIDATES]
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for the persistent local etag index."""
+
+from hashlib import md5
+import json
+import os
+from pathlib import Path
+import threading
+
+from webotron import util
+
+
+class EtagIndex:
+    """Remember the etags of local files between syncs.
+
+    Entries are keyed by the file's key relative to the site root and are
+    only trusted while the file's size, mtime and inode are unchanged, so
+    a file is only re-hashed after it has actually been touched.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        """Create an EtagIndex object backed by the file at path."""
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.entries = {}
+        # keys looked up since the index was loaded
+        self.touched = set()
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    @classmethod
+    def for_root(cls, root):
+        """Get the index for the site rooted at root in the cache dir."""
+        root = str(Path(root).expanduser().resolve())
+        name = 'etags-{}.json'.format(md5(root.encode('utf-8')).hexdigest())
+
+        return cls(util.get_cache_dir() / name)
+
+    def load(self):
+        """Load the index from disk, starting empty if it is unusable."""
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') == self.VERSION:
+            self.entries = data.get('entries', {})
+
+    def save(self):
+        """Write the index to disk atomically."""
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with self._lock:
+            data = {'version': self.VERSION, 'entries': self.entries}
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+        os.replace(str(tmp_path), str(self.path))
+
+    def clear(self):
+        """Forget every entry so the next sync re-hashes everything."""
+        with self._lock:
+            self.entries = {}
+
+    @staticmethod
+    def _stat_key(stat):
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def get(self, key, stat, chunk_size):
+        """Get the cached etag of key, or None if the file has changed."""
+        with self._lock:
+            self.touched.add(key)
+            entry = self.entries.get(key)
+            if entry and entry['stat'] == self._stat_key(stat):
+                etag = entry['etags'].get(str(chunk_size))
+                if etag is not None:
+                    self.hits += 1
+                    return etag
+            self.misses += 1
+
+        return None
+
+    def put(self, key, stat, chunk_size, etag):
+        """Remember the etag of key as of the given stat result."""
+        stat_key = self._stat_key(stat)
+        with self._lock:
+            entry = self.entries.get(key)
+            if not entry or entry['stat'] != stat_key:
+                entry = self.entries[key] = {'stat': stat_key, 'etags': {}}
+            entry['etags'][str(chunk_size)] = etag
+
+    def prune(self, keys=None):
+        """Drop entries for files that are no longer in keys.
+
+        keys defaults to the keys looked up since the index was loaded.
+        """
+        keys = self.touched if keys is None else set(keys)
+        with self._lock:
+            for key in list(self.entries):
+                if key not in keys:
+                    del self.entries[key]
+
+    def verify(self, files, gen_etag, chunk_size):
+        """Re-hash files and return keys whose cached etag is wrong.
+
+        files is an iterable of (path, key, stat) tuples.  Entries that are
+        stale are corrected in place.
+        """
+        bad_keys = []
+        for (path, key, stat) in files:
+            cached = self.get(key, stat, chunk_size)
+            if cached is None:
+                continue
+            etag = gen_etag(path)
+            if etag != cached:
+                bad_keys.append(key)
+                self.put(key, stat, chunk_size, etag)
+
+        return bad_keys
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for fingerprinting static assets with content-hashed names."""
+
+from hashlib import md5
+import os
+import posixpath
+import re
+import shutil
+
+from webotron import util
+from webotron.scanner import scan_tree
+
+# assets that get a content hash in their name
+ASSET_EXTENSIONS = {
+    '.css', '.js', '.mjs', '.png', '.jpg', '.jpeg', '.gif', '.svg', '.webp',
+    '.avif', '.ico', '.woff', '.woff2', '.ttf', '.otf', '.eot', '.mp4',
+    '.webm',
+}
+# files whose references to assets are rewritten
+REWRITE_EXTENSIONS = {'.html', '.htm', '.css'}
+# files fetched by fixed names, which must never be renamed
+WELL_KNOWN_NAMES = {
+    'favicon.ico', 'apple-touch-icon.png', 'apple-touch-icon-precomposed.png',
+    'sw.js', 'service-worker.js',
+}
+
+HTML_REF = re.compile(r'''(\b(?:src|href|poster)\s*=\s*)(["'])([^"']*)(\2)''',
+                      re.IGNORECASE)
+SRCSET_REF = re.compile(r'''(\bsrcset\s*=\s*)(["'])([^"']*)(\2)''',
+                        re.IGNORECASE)
+CSS_REF = re.compile(r'''(url\(\s*)(["']?)([^"')]*)(\2\s*\))''',
+                     re.IGNORECASE)
+CSS_IMPORT = re.compile(r'''(@import\s+)(["'])([^"']*)(\2)''', re.IGNORECASE)
+EXTERNAL_REF = re.compile(r'^(?:[a-z][a-z0-9+.-]*:|//|#)', re.IGNORECASE)
+
+
+def resolve_ref(ref, key):
+    """Get the key that ref, found in the file key, refers to.
+
+    Return None for external URLs, fragments and data URIs.
+    """
+    if not ref or EXTERNAL_REF.match(ref):
+        return None
+    path = re.split('[?#]', ref, 1)[0].replace('\\', '/')
+    if not path:
+        return None
+    if path.startswith('/'):
+        target = path.lstrip('/')
+    else:
+        target = posixpath.join(posixpath.dirname(key), path)
+    target = posixpath.normpath(target)
+
+    return None if target.startswith('..') else target
+
+
+class Fingerprinter:
+    """Build a copy of a site with fingerprinted asset names.
+
+    Each asset - stylesheets, scripts, images, fonts - referenced from
+    HTML or CSS gets a copy named name.<hash>.ext, where hash comes from
+    its content, and those references are rewritten to the new name.
+    The asset is kept under its old name too, for scripts and anything
+    else that refers to it in ways that aren't rewritten; root-level files
+    browsers fetch by name, such as favicon.ico, are never renamed.
+    Stylesheets are rewritten before they are hashed, so a changed image
+    also gives the stylesheets using it a new name.  The copy lives in the
+    webotron cache dir and only files whose output changed are rewritten,
+    so their mtimes stay put for the etag index.
+    """
+
+    HASH_LENGTH = 10
+
+    def __init__(self, pathname, path_filter=None):
+        """Create a Fingerprinter object for the site at pathname."""
+        self.root = os.path.realpath(os.path.expanduser(pathname))
+        self.path_filter = path_filter
+        self.staging_dir = str(util.get_cache_dir() / 'fingerprint' /
+                               md5(self.root.encode('utf-8')).hexdigest())
+        self.files = {}
+        self.renamed = {}
+        self.contents = {}
+
+    @staticmethod
+    def is_asset(key):
+        """Return true if key should be fingerprinted where referenced."""
+        if key.lower() in WELL_KNOWN_NAMES or key.startswith('.well-known/'):
+            return False
+
+        return posixpath.splitext(key)[1].lower() in ASSET_EXTENSIONS
+
+    @staticmethod
+    def is_rewritable(key):
+        """Return true if references in key should be rewritten."""
+        return posixpath.splitext(key)[1].lower() in REWRITE_EXTENSIONS
+
+    def _rename(self, key, visiting=()):
+        """Get the fingerprinted key for the asset key."""
+        if key in self.renamed:
+            return self.renamed[key]
+        if key in visiting:
+            # stylesheets importing each other - leave the cycle alone
+            return key
+
+        hash_ = md5()
+        if self.is_rewritable(key):
+            data = self._rewrite(key, visiting + (key,))
+            self.contents[key] = data
+            hash_.update(data)
+        else:
+            with open(self.files[key], 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    hash_.update(chunk)
+        (stem, ext) = posixpath.splitext(key)
+        self.renamed[key] = '{}.{}{}'.format(
+            stem, hash_.hexdigest()[:self.HASH_LENGTH], ext)
+
+        return self.renamed[key]
+
+    def _rewrite(self, key, visiting=()):
+        """Return the contents of key with asset references rewritten."""
+        with open(self.files[key], 'rb') as f:
+            text = f.read().decode('utf-8', 'surrogateescape')
+
+        def rename_ref(ref):
+            target = resolve_ref(ref, key)
+            if target not in self.files or not self.is_asset(target):
+                return ref
+            new_name = posixpath.basename(self._rename(target, visiting))
+            old_name = posixpath.basename(target)
+            path = re.split('[?#]', ref, 1)[0]
+            if not path.endswith(old_name):
+                return ref
+
+            return path[:-len(old_name)] + new_name + ref[len(path):]
+
+        def replace(match):
+            (before, quote, ref, after) = match.groups()
+
+            return before + quote + rename_ref(ref) + after
+
+        def replace_srcset(match):
+            (before, quote, value, after) = match.groups()
+            # comma separated candidates of a URL and an optional descriptor
+            candidates = [re.sub(r'^(\s*)(\S+)',
+                                 lambda m: m.group(1) + rename_ref(m.group(2)),
+                                 candidate)
+                          for candidate in value.split(',')]
+
+            return before + quote + ','.join(candidates) + after
+
+        if not key.lower().endswith('.css'):
+            text = HTML_REF.sub(replace, text)
+            text = SRCSET_REF.sub(replace_srcset, text)
+        for pattern in [CSS_REF, CSS_IMPORT]:
+            text = pattern.sub(replace, text)
+
+        return text.encode('utf-8', 'surrogateescape')
+
+    def _write(self, key, target_key):
+        """Write the output for key to target_key in the staging dir."""
+        target = os.path.join(self.staging_dir, *target_key.split('/'))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if key in self.contents:
+            data = self.contents[key]
+            try:
+                with open(target, 'rb') as f:
+                    if f.read() == data:
+                        return
+            except OSError:
+                pass
+            with open(target, 'wb') as f:
+                f.write(data)
+            return
+
+        source = os.stat(self.files[key])
+        try:
+            current = os.stat(target)
+            if (current.st_size, current.st_mtime_ns) == \
+                    (source.st_size, source.st_mtime_ns):
+                return
+        except OSError:
+            pass
+        shutil.copy2(self.files[key], target)
+
+    def build(self):
+        """Build the fingerprinted copy of the site.
+
+        Return the copy's path and the set of its fingerprinted keys.
+        """
+        self.files = {key: path for (path, key, stat)
+                      in scan_tree(self.root, self.path_filter)}
+        self.renamed = {}
+        self.contents = {}
+
+        # rewriting renames the assets that are referenced along the way
+        for key in sorted(self.files):
+            if self.is_rewritable(key) and key not in self.contents:
+                self.contents[key] = self._rewrite(key)
+
+        written = set()
+        for key in self.files:
+            for target_key in {key, self.renamed.get(key, key)}:
+                self._write(key, target_key)
+                written.add(target_key)
+        if os.path.isdir(self.staging_dir):
+            for (path, key, stat) in list(scan_tree(self.staging_dir)):
+                if key not in written:
+                    os.remove(path)
+
+        return (self.staging_dir, set(self.renamed.values()))
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for syncing only the files git says changed since a deploy."""
+
+from hashlib import md5
+import json
+import os
+from pathlib import Path
+import subprocess
+
+from botocore.exceptions import ClientError
+
+# the deploy marker is kept in bucket tags, which - unlike objects in a
+# website bucket - aren't public
+COMMIT_TAG = 'webotron:deployed-commit'
+STATE_TAG = 'webotron:deploy-state'
+
+
+class GitDelta:
+    """Work out the keys changed since the commit a bucket was synced from.
+
+    After a sync of a clean tree the HEAD commit and a hash of the options
+    that shape uploaded content are stored as tags on the bucket; a sync
+    with uncommitted files removes them instead.  The next sync diffs that
+    commit against HEAD and adds anything uncommitted now.  delta returns
+    None whenever that can't be trusted - no marker, history missing from
+    a shallow clone, other options or files git ignores - and a full sync
+    is needed.
+    """
+
+    def __init__(self, pathname):
+        """Create a GitDelta object for the tree at pathname."""
+        self.root = str(Path(pathname).expanduser().resolve())
+        self.prefix = None
+        self.head = None
+        # the commit a delta was taken from
+        self.base = None
+        self.reason = None
+
+    def git(self, *args):
+        """Run git in the tree and return its output."""
+        return subprocess.run(
+            ['git', '-C', self.root] + list(args), check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        ).stdout.decode('utf-8', 'surrogateescape')
+
+    def open(self):
+        """Find the repository; return false if the tree isn't in one."""
+        try:
+            self.prefix = self.git('rev-parse', '--show-prefix').strip()
+            self.head = self.git('rev-parse', '--verify', 'HEAD').strip()
+        except (OSError, subprocess.CalledProcessError):
+            self.reason = "not a git repository with commits"
+            return False
+
+        return True
+
+    def _key(self, path):
+        """Get the key for a path relative to the top of the repository."""
+        if path.startswith(self.prefix):
+            return path[len(self.prefix):]
+
+        return None
+
+    def dirty_keys(self):
+        """List the keys of files that differ from HEAD or are untracked."""
+        output = self.git('status', '--porcelain', '-z', '--no-renames',
+                          '--untracked-files=all', '--', '.')
+        keys = set()
+        for entry in output.split('\0'):
+            key = self._key(entry[3:]) if len(entry) > 3 else None
+            if key:
+                keys.add(key)
+
+        return keys
+
+    def ignored_keys(self):
+        """List the keys of files git ignores, which it can't track."""
+        output = self.git('ls-files', '-z', '--full-name', '--others',
+                          '--ignored', '--exclude-standard', '--', '.')
+
+        return {key for key in (self._key(path) for path in
+                                output.split('\0') if path) if key}
+
+    def state(self, options):
+        """Hash what besides the commit a delta depends on."""
+        state = json.dumps({'prefix': self.prefix, 'options': options},
+                           sort_keys=True)
+
+        return md5(state.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _tags(client, bucket_name):
+        """Get the bucket's tags as a dict."""
+        try:
+            tag_set = client.get_bucket_tagging(Bucket=bucket_name)['TagSet']
+        except ClientError as error:
+            if error.response['Error']['Code'] == 'NoSuchTagSet':
+                return {}
+            raise
+
+        return {tag['Key']: tag['Value'] for tag in tag_set}
+
+    def read_marker(self, client, bucket_name):
+        """Get the marker stored on the bucket, or None."""
+        tags = self._tags(client, bucket_name)
+        if COMMIT_TAG not in tags or STATE_TAG not in tags:
+            return None
+
+        return {'commit': tags[COMMIT_TAG], 'state': tags[STATE_TAG]}
+
+    def write_marker(self, client, bucket_name, options):
+        """Store HEAD on the bucket, or clear the marker if the tree is dirty.
+
+        Uncommitted files would have to be remembered for the next delta,
+        and their names aren't something to publish.
+        """
+        tags = {key: value for (key, value)
+                in self._tags(client, bucket_name).items()
+                if key not in (COMMIT_TAG, STATE_TAG)}
+        if not self.dirty_keys():
+            tags[COMMIT_TAG] = self.head
+            tags[STATE_TAG] = self.state(options)
+        if tags:
+            client.put_bucket_tagging(Bucket=bucket_name, Tagging={
+                'TagSet': [{'Key': key, 'Value': value}
+                           for (key, value) in sorted(tags.items())]})
+        else:
+            client.delete_bucket_tagging(Bucket=bucket_name)
+
+    def delta(self, marker, options, path_filter=None):
+        """Get the keys to upload and delete since marker was written.
+
+        Return a tuple of (changed, deleted) sets of keys, or None - with
+        reason set - when a full sync is needed.
+        """
+        if marker is None:
+            self.reason = "no clean deploy recorded on the bucket"
+            return None
+        if marker['state'] != self.state(options):
+            self.reason = "sync options changed since the last deploy"
+            return None
+        commit = marker.get('commit')
+        try:
+            self.git('cat-file', '-e', '{}^{{commit}}'.format(commit))
+        except subprocess.CalledProcessError:
+            self.reason = "deployed commit {} not in history".format(commit)
+            return None
+        self.base = commit
+        ignored = self.ignored_keys()
+        if path_filter:
+            ignored = {key for key in ignored if path_filter.covers(key)}
+        if ignored:
+            self.reason = "{} file(s) ignored by git".format(len(ignored))
+            return None
+
+        output = self.git('diff', '--name-only', '-z', '--no-renames',
+                          commit, 'HEAD', '--', '.')
+        keys = {key for key in (self._key(path) for path in
+                                output.split('\0') if path) if key}
+        keys |= self.dirty_keys()
+        if path_filter:
+            keys = {key for key in keys if path_filter.covers(key)}
+
+        changed = set()
+        deleted = set()
+        for key in keys:
+            if os.path.isfile(os.path.join(self.root, *key.split('/'))):
+                changed.add(key)
+            else:
+                deleted.add(key)
+
+        return (changed, deleted)
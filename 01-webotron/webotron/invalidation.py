@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""Provide minimal CloudFront invalidation path sets for a sync."""
+
+from collections import Counter
+from urllib.parse import quote
+
+# CloudFront allows this many file paths and wildcard paths to be in
+# progress per distribution at once
+MAX_PATHS = 3000
+MAX_WILDCARDS = 15
+# a directory with more changed paths than this is invalidated as dir/*
+DIR_THRESHOLD = 10
+INDEX_DOCUMENT = 'index.html'
+
+
+def _ancestors(path):
+    """List the directories containing path, deepest first.
+
+    A wildcard 'dir/*' is contained by the parents of 'dir/', not by
+    'dir/' itself.
+    """
+    if path.endswith('*'):
+        path = path[:-1]
+    parts = path.rstrip('/').split('/')
+
+    return ['/'.join(parts[:depth]) + '/'
+            for depth in range(len(parts) - 1, 0, -1)]
+
+
+def _collapse(paths, directory):
+    """Replace every path under directory with directory/*."""
+    return {path for path in paths if not path.startswith(directory)} | \
+        {directory + '*'}
+
+
+def _shrink(paths, max_paths, max_wildcards):
+    """Collapse directories until both path limits are met."""
+    while True:
+        wildcards = [path for path in paths if path.endswith('*')]
+        if len(wildcards) > max_wildcards:
+            # only merging wildcards brings their number down
+            counted = wildcards
+        elif len(paths) > max_paths:
+            counted = paths
+        else:
+            return paths
+        counts = Counter(directory for path in counted
+                         for directory in _ancestors(path))
+        candidates = [(len(directory), count, directory)
+                      for (directory, count) in counts.items() if count > 1]
+        if not candidates:
+            return {'/*'}
+        # the deepest directory holding more than one path invalidates the
+        # fewest extra objects
+        paths = _collapse(paths, max(candidates)[2])
+
+
+def invalidation_paths(keys, dir_threshold=DIR_THRESHOLD,
+                       max_paths=MAX_PATHS, max_wildcards=MAX_WILDCARDS):
+    """Compute a small set of CloudFront paths that covers keys.
+
+    Keys named index.html also invalidate their directory's URL.
+    Directories with more than dir_threshold changed paths become
+    'dir/*'.  While there are more than max_wildcards wildcards, the ones
+    covering the fewest paths are turned back into those paths as long
+    as there are no more than max_paths paths; only then are more
+    directories collapsed.  Return a sorted list.
+    """
+    paths = set()
+    for key in keys:
+        path = '/' + quote(key, safe="/~!$&'()+,;=:@")
+        paths.add(path)
+        if path.rpartition('/')[2] == INDEX_DOCUMENT:
+            paths.add(path[:-len(INDEX_DOCUMENT)])
+
+    explicit = set(paths)
+    counts = Counter(path.rpartition('/')[0] + '/' for path in paths
+                     if not path.endswith('/'))
+    for (directory, count) in counts.items():
+        if count > dir_threshold:
+            paths = _collapse(paths, directory)
+    # a wildcard swallows any deeper wildcards
+    for path in sorted(path for path in paths if path.endswith('*')):
+        if path in paths:
+            paths = _collapse(paths, path[:-1])
+
+    # too many wildcards: list the paths of the smallest ones again while
+    # that fits, before _shrink merges the rest into wider wildcards
+    covered = {path: {p for p in explicit if p.startswith(path[:-1])}
+               for path in paths if path.endswith('*')}
+    for path in sorted(covered, key=lambda path: len(covered[path])):
+        if len(covered) <= max_wildcards or \
+                len(paths) - 1 + len(covered[path]) > max_paths:
+            break
+        paths = (paths - {path}) | covered.pop(path)
+
+    return sorted(_shrink(paths, max_paths, max_wildcards))
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for the crash-safe sync checkpoint journal."""
+
+from hashlib import md5
+import json
+import os
+from pathlib import Path
+import threading
+
+from webotron import util
+
+
+class SyncJournal:
+    """Append-only record of the uploads a sync has completed.
+
+    Every finished upload, every multipart upload started and every part
+    uploaded is appended as a JSON line and flushed to disk straight
+    away, so a sync that is killed part way can be resumed: finished files
+    are skipped and large files carry on from their last uploaded part.
+    A torn last line from a crash is ignored when the journal is loaded.
+    """
+
+    def __init__(self, path):
+        """Create a SyncJournal object backed by the file at path."""
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.done = {}
+        self.uploads = {}
+        self.load()
+        self._file = open(self.path, 'a')
+
+    @classmethod
+    def for_sync(cls, bucket_name, root):
+        """Get the journal for syncing root to bucket_name."""
+        root = str(Path(root).expanduser().resolve())
+        name = 'journal-{}.jsonl'.format(
+            md5('{}:{}'.format(bucket_name, root).encode('utf-8'))
+            .hexdigest())
+
+        return cls(util.get_cache_dir() / name)
+
+    def load(self):
+        """Replay the journal file into done and uploads."""
+        try:
+            with open(self.path, 'r') as f:
+                lines = f.readlines()
+        except OSError:
+            return
+        for line in lines:
+            try:
+                self._apply(json.loads(line))
+            except (ValueError, KeyError):
+                continue
+
+    def _apply(self, record):
+        """Update the in-memory state from one journal record."""
+        op = record['op']
+        if op == 'done':
+            self.done[record['key']] = record['etag']
+        elif op == 'mpu':
+            self.uploads[record['upload_id']] = {
+                'key': record['key'],
+                'etag': record['etag'],
+                'part_size': record['part_size'],
+                'parts': {}
+            }
+        elif op == 'part' and record['upload_id'] in self.uploads:
+            self.uploads[record['upload_id']]['parts'][record['n']] = \
+                record['etag']
+        elif op == 'mpu_end':
+            self.uploads.pop(record['upload_id'], None)
+
+    def _append(self, record, sync_to_disk=False):
+        """Apply record and append it to the journal file."""
+        with self._lock:
+            self._apply(record)
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+            if sync_to_disk:
+                os.fsync(self._file.fileno())
+
+    def completed_etag(self, key):
+        """Get the etag key was uploaded with, if it finished uploading."""
+        return self.done.get(key)
+
+    def find_upload(self, key, etag, part_size):
+        """Find an unfinished multipart upload of this content to key.
+
+        Return a tuple of the upload id and a dict of part number: etag,
+        or None.
+        """
+        with self._lock:
+            for (upload_id, upload) in self.uploads.items():
+                if (upload['key'], upload['etag'], upload['part_size']) == \
+                        (key, etag, part_size):
+                    return (upload_id, dict(upload['parts']))
+
+        return None
+
+    def record_done(self, key, etag):
+        """Note that key has been uploaded with etag."""
+        self._append({'op': 'done', 'key': key, 'etag': etag})
+
+    def record_upload(self, key, etag, upload_id, part_size):
+        """Note that a multipart upload of key has been started."""
+        self._append({'op': 'mpu', 'key': key, 'etag': etag,
+                      'upload_id': upload_id, 'part_size': part_size},
+                     sync_to_disk=True)
+
+    def record_part(self, upload_id, number, etag):
+        """Note that part number of upload_id has been uploaded."""
+        self._append({'op': 'part', 'upload_id': upload_id, 'n': number,
+                      'etag': etag}, sync_to_disk=True)
+
+    def record_upload_end(self, upload_id):
+        """Note that upload_id was completed or aborted."""
+        self._append({'op': 'mpu_end', 'upload_id': upload_id})
+
+    def reset(self):
+        """Empty the journal after a sync has finished cleanly."""
+        with self._lock:
+            self._file.close()
+            self.done = {}
+            self.uploads = {}
+            self._file = open(self.path, 'w')
+
+    def close(self):
+        """Close the journal file."""
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""Provide prefix-sharded parallel listing of S3 buckets and its output."""
+
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import json
+import queue
+import threading
+
+_DONE = object()
+FIELDS = ['Key', 'Size', 'LastModified', 'ETag', 'StorageClass']
+AGGREGATE_FIELDS = ['Prefix', 'StorageClass', 'Count', 'Size']
+
+
+def _iter_pages(client, bucket_name, prefixes, workers, **kwargs):
+    """Yield list_objects_v2 pages for prefixes, fetched concurrently."""
+    pages = queue.Queue(maxsize=workers * 4)
+    stop = threading.Event()
+
+    def put(item):
+        # never block forever - the consumer may have stopped reading
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def list_prefix(prefix):
+        paginator = client.get_paginator('list_objects_v2')
+        try:
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix,
+                                           **kwargs):
+                if stop.is_set():
+                    return
+                put(page)
+        except Exception as error:  # pylint: disable=broad-except
+            put(error)
+        put(_DONE)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(list_prefix, prefix)
+                   for prefix in prefixes]
+        pending = len(futures)
+        try:
+            while pending:
+                item = pages.get()
+                if item is _DONE:
+                    pending -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+            for future in futures:
+                future.cancel()
+
+
+def iter_objects(client, bucket_name, prefix='', shards=1, max_depth=2):
+    """Yield every object under prefix as a list_objects_v2 dict.
+
+    With shards > 1 the key space is split on '/' into sub-prefixes -
+    going up to max_depth levels deep until there are at least shards of
+    them - and up to shards prefixes are listed at the same time.  Objects
+    are yielded in no particular order.
+    """
+    if shards <= 1:
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            yield from page.get('Contents', [])
+        return
+
+    # every delimited listing returns the objects directly under a prefix
+    # plus the next level of prefixes, so discovery never lists a key twice
+    prefixes = [prefix]
+    for _ in range(max_depth):
+        if len(prefixes) >= shards:
+            break
+        next_prefixes = []
+        for page in _iter_pages(client, bucket_name, prefixes, shards,
+                                Delimiter='/'):
+            yield from page.get('Contents', [])
+            next_prefixes.extend(common['Prefix']
+                                 for common in page.get('CommonPrefixes', []))
+        prefixes = next_prefixes
+
+    for page in _iter_pages(client, bucket_name, prefixes, shards):
+        yield from page.get('Contents', [])
+
+
+def object_row(obj):
+    """Get the FIELDS of a list_objects_v2 object dict as plain values."""
+    return {
+        'Key': obj['Key'],
+        'Size': obj['Size'],
+        'LastModified': obj['LastModified'].isoformat(),
+        'ETag': obj['ETag'].strip('"'),
+        'StorageClass': obj.get('StorageClass', 'STANDARD'),
+    }
+
+
+class PrefixAggregator:
+    """Count objects and bytes per key prefix and storage class.
+
+    Prefixes are the first depth '/' separated parts of each key; keys
+    with fewer parts count under their directory, '' at the top.  At most
+    max_groups groups are kept: objects that would start a new group
+    after that are counted under OTHER, so memory stays bounded however
+    many prefixes the bucket has.
+    """
+
+    OTHER = '(other)'
+
+    def __init__(self, depth=1, max_groups=10000):
+        """Create an empty PrefixAggregator object."""
+        self.depth = depth
+        self.max_groups = max_groups
+        # (prefix, storage class): [count, bytes]
+        self.groups = {}
+
+    def prefix(self, key):
+        """Get the prefix key is counted under."""
+        parts = key.split('/')[:-1][:self.depth]
+
+        return '/'.join(parts) + '/' if parts else ''
+
+    def add(self, obj):
+        """Count a list_objects_v2 object dict."""
+        group = (self.prefix(obj['Key']),
+                 obj.get('StorageClass', 'STANDARD'))
+        totals = self.groups.get(group)
+        if totals is None:
+            if len(self.groups) >= self.max_groups:
+                group = (self.OTHER, group[1])
+            totals = self.groups.setdefault(group, [0, 0])
+        totals[0] += 1
+        totals[1] += obj['Size']
+
+    def rows(self):
+        """Return the AGGREGATE_FIELDS of every group, sorted."""
+        return [{'Prefix': prefix, 'StorageClass': storage_class,
+                 'Count': count, 'Size': size}
+                for ((prefix, storage_class), (count, size))
+                in sorted(self.groups.items())]
+
+
+def write_rows(rows, out, output_format, fields):
+    """Write dict rows to out as 'jsonl', 'csv' or aligned 'text'.
+
+    rows may be a generator; each row is written as soon as it comes.
+    """
+    if output_format == 'jsonl':
+        for row in rows:
+            out.write(json.dumps(row) + '\n')
+    elif output_format == 'csv':
+        writer = csv.DictWriter(out, fieldnames=fields, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            out.write('  '.join(str(row[field]) or '-' for field in fields) +
+                      '\n')
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for a compact in-memory manifest of bucket contents."""
+
+from array import array
+import binascii
+import sys
+import threading
+
+
+def parse_etag(etag):
+    """Split a quoted S3 ETag into its 16 byte digest and part count.
+
+    Single part ETags have a part count of 0.  Return None for ETags that
+    are not of the usual md5 form.
+    """
+    if not etag:
+        return None
+    (digest, _, parts) = etag.strip('"').partition('-')
+    try:
+        digest = binascii.unhexlify(digest)
+        parts = int(parts) if parts else 0
+    except (binascii.Error, ValueError):
+        return None
+    if len(digest) != 16:
+        return None
+
+    return (digest, parts)
+
+
+def format_etag(digest, parts):
+    """Build a quoted S3 ETag from a digest and part count."""
+    etag = binascii.hexlify(digest).decode('ascii')
+    if parts:
+        etag = '{}-{}'.format(etag, parts)
+
+    return '"{}"'.format(etag)
+
+
+class Manifest:
+    """Map the keys of a bucket to their ETags using little memory.
+
+    Keys are stored split at their last '/' so the directory part is held
+    once per directory.  Each key gets a slot number into flat arrays: the
+    16 byte digest of its ETag, its part count, its size and a bitmap of
+    the keys seen locally during a sync.
+
+    Keys may be looked up while another thread is still adding them: a
+    key only becomes visible once its slot is fully filled in.
+    """
+
+    def __init__(self):
+        """Create an empty Manifest object."""
+        self._dirs = {}
+        self._digests = bytearray()
+        self._parts = array('I')
+        self._sizes = array('Q')
+        self._seen = bytearray()
+        # ETags that aren't md5 based, by slot - rare enough for a dict
+        self._other = {}
+        # slots of keys removed by discard
+        self._discarded = 0
+        # ETag to key, built by key_for when first needed
+        self._by_etag = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _split(key):
+        (prefix, sep, name) = key.rpartition('/')
+        return (prefix + sep, name)
+
+    def _slot(self, key):
+        (prefix, name) = self._split(key)
+        names = self._dirs.get(prefix)
+
+        return None if names is None else names.get(name)
+
+    def __len__(self):
+        """Return the number of keys."""
+        return len(self._parts) - self._discarded
+
+    def __contains__(self, key):
+        """Return true if key is in the manifest."""
+        return self._slot(key) is not None
+
+    def __iter__(self):
+        """Iterate over all keys."""
+        for (prefix, names) in self._dirs.items():
+            for name in names:
+                yield prefix + name
+
+    def add(self, key, etag, size=0):
+        """Add key with its quoted ETag, replacing any existing entry."""
+        parsed = parse_etag(etag)
+        (digest, parts) = parsed or (bytes(16), 0)
+        with self._lock:
+            slot = self._slot(key)
+            if slot is None:
+                slot = len(self._parts)
+                self._digests += digest
+                self._parts.append(parts)
+                self._sizes.append(size)
+                if slot % 8 == 0:
+                    self._seen.append(0)
+            else:
+                self._digests[slot * 16:slot * 16 + 16] = digest
+                self._parts[slot] = parts
+                self._sizes[slot] = size
+            if parsed is None:
+                self._other[slot] = etag
+            else:
+                self._other.pop(slot, None)
+            # publish the key last, once its slot is complete
+            (prefix, name) = self._split(key)
+            self._dirs.setdefault(prefix, {})[name] = slot
+            if self._by_etag is not None and parsed is not None:
+                self._by_etag.setdefault(digest + bytes([parts % 256]), key)
+
+    def discard(self, key):
+        """Remove key if present.  Its slot is not reused."""
+        (prefix, name) = self._split(key)
+        with self._lock:
+            names = self._dirs.get(prefix)
+            if names is not None and names.pop(name, None) is not None:
+                self._discarded += 1
+                if not names:
+                    del self._dirs[prefix]
+
+    def get(self, key, default=None):
+        """Get the quoted ETag of key."""
+        slot = self._slot(key)
+        if slot is None:
+            return default
+        if slot in self._other:
+            return self._other[slot]
+
+        return format_etag(self._digests[slot * 16:slot * 16 + 16],
+                           self._parts[slot])
+
+    def key_for(self, etag):
+        """Get a key whose ETag is etag, or None.
+
+        The index of keys by ETag is only built on first use, as most syncs
+        never need it.
+        """
+        parsed = parse_etag(etag)
+        if parsed is None:
+            return None
+        with self._lock:
+            if self._by_etag is None:
+                self._by_etag = {}
+                for (prefix, names) in self._dirs.items():
+                    for (name, slot) in names.items():
+                        if slot not in self._other:
+                            self._by_etag.setdefault(
+                                bytes(self._digests[slot * 16:slot * 16 + 16])
+                                + bytes([self._parts[slot] % 256]),
+                                prefix + name)
+            key = self._by_etag.get(parsed[0] + bytes([parsed[1] % 256]))
+
+        # the key may have been discarded or replaced since
+        return key if key is not None and self.matches(key, etag) else None
+
+    def parts(self, key):
+        """Get the multipart part count of key (0 for a single part)."""
+        slot = self._slot(key)
+
+        return None if slot is None else self._parts[slot]
+
+    def size(self, key):
+        """Get the size in bytes of key."""
+        slot = self._slot(key)
+
+        return None if slot is None else self._sizes[slot]
+
+    def matches(self, key, etag):
+        """Return true if key is present with the quoted ETag etag."""
+        slot = self._slot(key)
+        if slot is None or etag is None:
+            return False
+        if slot in self._other:
+            return self._other[slot] == etag
+        parsed = parse_etag(etag)
+
+        return parsed is not None and \
+            parsed[1] == self._parts[slot] and \
+            parsed[0] == self._digests[slot * 16:slot * 16 + 16]
+
+    def mark_seen(self, key):
+        """Flag key as present locally; return true if it is in the bucket."""
+        slot = self._slot(key)
+        if slot is None:
+            return False
+        with self._lock:
+            self._seen[slot >> 3] |= 1 << (slot & 7)
+
+        return True
+
+    def unseen(self):
+        """Iterate over the keys that were never marked as seen."""
+        for (prefix, names) in self._dirs.items():
+            for (name, slot) in names.items():
+                if not self._seen[slot >> 3] & (1 << (slot & 7)):
+                    yield prefix + name
+
+    def memory_usage(self):
+        """Estimate the bytes of memory used to hold the manifest."""
+        size = sys.getsizeof(self._dirs) + sys.getsizeof(self._digests) + \
+            sys.getsizeof(self._parts) + sys.getsizeof(self._sizes) + \
+            sys.getsizeof(self._seen) + \
+            sys.getsizeof(self._other)
+        for (prefix, names) in self._dirs.items():
+            size += sys.getsizeof(prefix) + sys.getsizeof(names)
+            size += sum(sys.getsizeof(name) for name in names)
+        size += sum(sys.getsizeof(etag) for etag in self._other.values())
+        # slot numbers above 256 are separate int objects
+        size += max(0, len(self) - 257) * sys.getsizeof(257)
+
+        return size
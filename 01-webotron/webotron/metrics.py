@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for measuring where a webotron run spends its time."""
+
+from contextlib import contextmanager
+import json
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # resource is Unix only - peak memory is then unknown
+    resource = None
+
+
+def peak_memory():
+    """Get the peak resident memory of this process in bytes, or None."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports KiB, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _label(value):
+    """Escape value for use as a Prometheus label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+class Metrics:
+    """Collect phase timings, byte counts and API call statistics.
+
+    Phases are timed with the phase context manager or added from sync
+    pipeline stage stats.  API calls are counted and timed per service and
+    operation through botocore event hooks on every registered client,
+    including the retries botocore made for them.
+    """
+
+    def __init__(self):
+        """Create an empty Metrics object."""
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        # name: [wall seconds, busy seconds or None, items or None]
+        self.phases = {}
+        self.bytes = {'hashed': 0, 'sent': 0}
+        # (service, operation): [calls, errors, retries, total, max latency]
+        self.api = {}
+
+    def register(self, client):
+        """Register the metrics for every request made through client."""
+        events = client.meta.events
+        events.register('before-call', self._before_call)
+        events.register('after-call', self._after_call)
+        events.register('after-call-error', self._after_call_error)
+        events.register('before-send', self._before_send)
+
+    @contextmanager
+    def phase(self, name):
+        """Time the body of a with statement as the phase name."""
+        began = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - began)
+
+    def add_phase(self, name, wall, busy=None, items=None):
+        """Add wall seconds - and busy seconds over items - to a phase."""
+        with self._lock:
+            totals = self.phases.setdefault(name, [0.0, None, None])
+            totals[0] += wall
+            if busy is not None:
+                totals[1] = (totals[1] or 0.0) + busy
+                totals[2] = (totals[2] or 0) + items
+
+    def add_stages(self, stages):
+        """Add the StageStats of a sync pipeline as sync_<stage> phases."""
+        for stage in stages:
+            if stage.started is None:
+                continue
+            self.add_phase('sync_' + stage.name,
+                           (stage.finished or stage.started) - stage.started,
+                           stage.busy, stage.items)
+
+    def add_bytes(self, kind, count):
+        """Count count bytes that were hashed or sent."""
+        with self._lock:
+            self.bytes[kind] = self.bytes.get(kind, 0) + count
+
+    def _record(self, context, error, retries=0):
+        """Count one finished API call."""
+        if 'metrics_operation' not in context:
+            return
+        operation = context.pop('metrics_operation')
+        latency = time.perf_counter() - context.pop('metrics_started')
+        with self._lock:
+            totals = self.api.setdefault(operation, [0, 0, 0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += error
+            totals[2] += retries
+            totals[3] += latency
+            totals[4] = max(totals[4], latency)
+
+    def _before_call(self, model, context, **kwargs):
+        """Event hook: note which call this is and when it started."""
+        context['metrics_operation'] = (
+            model.service_model.service_id.hyphenize(), model.name)
+        context['metrics_started'] = time.perf_counter()
+
+    def _after_call(self, http_response, parsed, context, **kwargs):
+        """Event hook: count a call that got a response."""
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        self._record(context, http_response.status_code >= 300, retries)
+
+    def _after_call_error(self, context, **kwargs):
+        """Event hook: count a call that failed without a response."""
+        self._record(context, True)
+
+    def _before_send(self, request, **kwargs):
+        """Event hook: count the bytes of a request body."""
+        size = request.headers.get('X-Amz-Decoded-Content-Length') or \
+            request.headers.get('Content-Length')
+        if size:
+            self.add_bytes('sent', int(size))
+
+    def to_dict(self):
+        """Return the metrics as a JSON serializable dict."""
+        with self._lock:
+            return {
+                'elapsed_seconds': time.perf_counter() - self.started,
+                'peak_memory_bytes': peak_memory(),
+                'phases': {
+                    name: {'wall_seconds': wall, 'busy_seconds': busy,
+                           'items': items}
+                    for (name, (wall, busy, items))
+                    in sorted(self.phases.items())},
+                'bytes': dict(self.bytes),
+                'api_calls': [
+                    {'service': service, 'operation': operation,
+                     'calls': calls, 'errors': errors, 'retries': retries,
+                     'latency_seconds_total': total,
+                     'latency_seconds_max': longest}
+                    for ((service, operation),
+                         (calls, errors, retries, total, longest))
+                    in sorted(self.api.items())],
+            }
+
+    def write_json(self, path):
+        """Write the metrics to path as JSON."""
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        data = self.to_dict()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP webotron_{} {}'.format(name, help_text))
+            lines.append('# TYPE webotron_{} {}'.format(name, kind))
+            for (labels, value) in samples:
+                label_text = ','.join('{}="{}"'.format(key, _label(val))
+                                      for (key, val) in labels)
+                lines.append('webotron_{}{} {}'.format(
+                    name, '{' + label_text + '}' if label_text else '',
+                    value))
+
+        metric('elapsed_seconds', 'gauge', 'Wall time of the run.',
+               [((), data['elapsed_seconds'])])
+        if data['peak_memory_bytes'] is not None:
+            metric('peak_memory_bytes', 'gauge',
+                   'Peak resident memory of the process.',
+                   [((), data['peak_memory_bytes'])])
+        phases = data['phases'].items()
+        metric('phase_seconds', 'gauge', 'Wall time of each phase.',
+               [((('phase', name),), phase['wall_seconds'])
+                for (name, phase) in phases])
+        metric('phase_busy_seconds', 'gauge',
+               'Time workers spent busy in each pipeline stage.',
+               [((('phase', name),), phase['busy_seconds'])
+                for (name, phase) in phases
+                if phase['busy_seconds'] is not None])
+        metric('phase_items', 'gauge', 'Items handled by each stage.',
+               [((('phase', name),), phase['items'])
+                for (name, phase) in phases if phase['items'] is not None])
+        metric('bytes_total', 'counter', 'Bytes hashed and sent.',
+               [((('kind', kind),), count)
+                for (kind, count) in sorted(data['bytes'].items())])
+        calls = [((('service', call['service']),
+                   ('operation', call['operation'])), call)
+                 for call in data['api_calls']]
+        for (name, field, kind, help_text) in [
+                ('api_calls_total', 'calls', 'counter', 'API calls made.'),
+                ('api_errors_total', 'errors', 'counter',
+                 'API calls that failed.'),
+                ('api_retries_total', 'retries', 'counter',
+                 'Retries botocore made for API calls.'),
+                ('api_latency_seconds_sum', 'latency_seconds_total',
+                 'counter', 'Total latency of API calls.'),
+                ('api_latency_seconds_max', 'latency_seconds_max', 'gauge',
+                 'Longest API call.')]:
+            metric(name, kind, help_text,
+                   [(labels, call[field]) for (labels, call) in calls])
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """Write the metrics to path in Prometheus text format."""
+        with open(path, 'w') as f:
+            f.write(self.prometheus())
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""Provide a fast filtered walk of a local directory tree."""
+
+from fnmatch import fnmatchcase
+import os
+from pathlib import Path
+
+
+class PathFilter:
+    """Decide which keys a sync covers from include/exclude glob patterns.
+
+    A pattern matches a key if it matches the whole key or its last
+    component, so '.git', 'node_modules', '*.swp' and 'drafts/*' all work.
+    A file is covered if it matches no exclude pattern and, when include
+    patterns are given, matches at least one of them.  A directory that
+    matches an exclude pattern is skipped along with everything in it.
+    """
+
+    def __init__(self, include=(), exclude=()):
+        """Create a PathFilter object."""
+        self.include = list(include)
+        self.exclude = list(exclude)
+
+    def __bool__(self):
+        """Return true if the filter has any patterns."""
+        return bool(self.include or self.exclude)
+
+    @staticmethod
+    def _matches(patterns, key, name):
+        return any(fnmatchcase(key, pattern) or fnmatchcase(name, pattern)
+                   for pattern in patterns)
+
+    def dir_excluded(self, key, name):
+        """Return true if the directory key should not be descended."""
+        return self._matches(self.exclude, key, name)
+
+    def file_included(self, key, name):
+        """Return true if the file key should be synced."""
+        if self._matches(self.exclude, key, name):
+            return False
+
+        return not self.include or self._matches(self.include, key, name)
+
+    def covers(self, key):
+        """Return true if key - a file, maybe in subdirectories - is synced.
+
+        Used for bucket keys, which have no directory entries of their own.
+        """
+        parts = key.split('/')
+        for depth in range(1, len(parts)):
+            if self.dir_excluded('/'.join(parts[:depth]), parts[depth - 1]):
+                return False
+
+        return self.file_included(key, parts[-1])
+
+
+def scan_tree(pathname, path_filter=None, prefix=''):
+    """Yield (path, key, stat) for every file under pathname.
+
+    The walk is iterative, so deep trees don't hit the recursion limit,
+    and uses os.scandir so file types and stat results come from the
+    directory entries rather than extra system calls where the platform
+    allows.  Excluded directories are never descended.  Keys are relative
+    to pathname; prefix is put in front of them when pathname is itself
+    a directory inside the tree being synced.
+    """
+    root = str(Path(pathname).expanduser().resolve())
+    path_filter = path_filter or PathFilter()
+    # (directory path, its key prefix)
+    stack = [(root, prefix)]
+
+    while stack:
+        (directory, prefix) = stack.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                key = prefix + entry.name
+                if entry.is_dir():
+                    if not path_filter.dir_excluded(key, entry.name):
+                        stack.append((entry.path, key + '/'))
+                elif entry.is_file():
+                    if path_filter.file_included(key, entry.name):
+                        yield (entry.path, key, entry.stat())
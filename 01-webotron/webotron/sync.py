@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for running a bucket sync and tracking its results."""
+
+import mimetypes
+import queue
+import threading
+import time
+
+from webotron.listing import iter_objects
+
+
+class SyncSummary:
+    """Collect per-key results of a sync in a thread-safe way."""
+
+    def __init__(self):
+        """Create an empty SyncSummary object."""
+        self._lock = threading.Lock()
+        self.uploaded = []
+        self.copied = []
+        self.skipped = []
+        self.deleted = []
+        # uploaded keys that replaced an existing object
+        self.overwritten = []
+        self.failed = {}
+        self.delete_held = None
+        self.compressed = None
+        self.manifest_keys = None
+        self.manifest_bytes = None
+        self.etag_index_hits = None
+        self.etag_index_misses = None
+        self.stages = []
+        self.origin = None
+        self.throttle = []
+        self.git_delta = None
+
+    def record(self, action, key):
+        """Record the action - 'uploaded', 'deleted', ... - done for key."""
+        with self._lock:
+            getattr(self, action).append(key)
+
+    def record_failure(self, key, error):
+        """Record that the operation for key failed with error."""
+        with self._lock:
+            self.failed[key] = str(error)
+
+    def changed_keys(self):
+        """Get the keys whose old content may be cached by a CDN."""
+        return self.overwritten + self.deleted
+
+    def report(self):
+        """Return the summary lines, sorted so output is deterministic."""
+        lines = ["Sync summary: {} uploaded, {} copied, {} skipped, "
+                 "{} deleted, {} failed".format(
+                     len(self.uploaded), len(self.copied), len(self.skipped),
+                     len(self.deleted), len(self.failed))]
+        if self.git_delta is not None:
+            lines.append("Git delta: {}".format(self.git_delta))
+        if self.manifest_keys is not None:
+            lines.append("Manifest: {} keys in {:.1f} KiB".format(
+                self.manifest_keys, self.manifest_bytes / 1024))
+        if self.compressed is not None:
+            lines.append("Compression: {} compressed, {} from cache".format(
+                *self.compressed))
+        if self.delete_held and self.delete_held[0]:
+            lines.append("Not deleting {} stale key(s): {}".format(
+                *self.delete_held))
+        if self.etag_index_hits is not None:
+            lines.append("Etag index: {} cached, {} hashed".format(
+                self.etag_index_hits, self.etag_index_misses))
+        lines.extend(self.throttle)
+        if self.stages:
+            lines.append("Pipeline stages:")
+            lines.extend(stage.report(self.origin) for stage in self.stages)
+        for key in sorted(self.failed):
+            lines.append("  FAILED {}: {}".format(key, self.failed[key]))
+
+        return lines
+
+
+class StageStats:
+    """Timings and queue depth of one sync pipeline stage."""
+
+    def __init__(self, name):
+        """Create a StageStats object for the stage called name."""
+        self.name = name
+        self._lock = threading.Lock()
+        self.started = None
+        self.finished = None
+        self.items = 0
+        self.busy = 0.0
+        self.max_depth = 0
+
+    def start(self):
+        """Note that the stage has started, if it hasn't already."""
+        with self._lock:
+            if self.started is None:
+                self.started = time.perf_counter()
+
+    def finish(self):
+        """Note that the stage has finished."""
+        with self._lock:
+            self.finished = time.perf_counter()
+
+    def add(self, busy, count=1):
+        """Count count items handled in busy seconds of work."""
+        with self._lock:
+            self.items += count
+            self.busy += busy
+
+    def put(self, stage_queue, item):
+        """Put item on the stage's input queue, tracking its depth."""
+        stage_queue.put(item)
+        depth = stage_queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def report(self, origin):
+        """Return the report line for the stage; times are from origin."""
+        start = (self.started or origin) - origin
+        end = (self.finished or origin) - origin
+
+        return "  {:<8} {:>7} items  {:7.2f}s - {:7.2f}s  busy {:8.2f}s  " \
+            "max queue {}".format(self.name, self.items, start, end,
+                                  self.busy, self.max_depth)
+
+
+class SyncPipeline:
+    """Run the phases of a sync as concurrent stages.
+
+    Listing the bucket, walking the local tree, hashing files and
+    uploading them all run at the same time, connected by bounded queues:
+
+        listing  --> manifest
+        walk     --> hash queue --> hash workers --> upload queue
+        upload workers: compare with manifest, then upload or skip
+
+    A file whose key hasn't been listed yet is held back until the listing
+    has finished, as until then it can't be told apart from a new file.
+    Stale keys are deleted once everything else is done.
+
+    For a delta sync the files and stale keys are given to run: the bucket
+    isn't listed, the tree isn't walked and every given file is uploaded.
+    """
+
+    QUEUE_FACTOR = 4
+
+    def __init__(self, bucket_manager, bucket, summary, workers=1,
+                 list_shards=1, path_filter=None, compressor=None):
+        """Create a SyncPipeline object syncing to bucket."""
+        self.bucket_manager = bucket_manager
+        self.bucket = bucket
+        self.summary = summary
+        self.workers = workers
+        self.list_shards = list_shards
+        self.path_filter = path_filter
+        self.compressor = compressor
+
+        self.hash_queue = queue.Queue(maxsize=workers * self.QUEUE_FACTOR)
+        self.upload_queue = queue.Queue(maxsize=workers * self.QUEUE_FACTOR)
+        self.stages = [StageStats(name) for name in
+                       ('listing', 'walk', 'hash', 'upload', 'delete')]
+        (self.listing_stats, self.walk_stats, self.hash_stats,
+         self.upload_stats, self.delete_stats) = self.stages
+        self.summary.stages = self.stages
+
+        self._lock = threading.Lock()
+        self._listing_done = False
+        self._listing_error = None
+        self._walk_error = None
+        self._waiting = []
+        self._listed = True
+
+    def _list(self):
+        """Stage: list the bucket into the manifest."""
+        manifest = self.bucket_manager.manifest
+        self.listing_stats.start()
+        try:
+            for obj in iter_objects(self.bucket_manager.s3.meta.client,
+                                    self.bucket.name,
+                                    shards=self.list_shards):
+                manifest.add(obj['Key'], obj['ETag'], obj['Size'])
+                self.listing_stats.items += 1
+        except Exception as error:  # pylint: disable=broad-except
+            self._listing_error = error
+        finally:
+            with self._lock:
+                self._listing_done = True
+                (waiting, self._waiting) = (self._waiting, [])
+            self.listing_stats.finish()
+            self.listing_stats.busy = \
+                self.listing_stats.finished - self.listing_stats.started
+            # files held back for the listing can be decided now
+            for item in waiting:
+                self.upload_stats.put(self.upload_queue, item)
+
+    def _walk(self, pathname, files=None):
+        """Stage: walk the local tree onto the hash queue."""
+        self.walk_stats.start()
+        try:
+            if files is None:
+                files = self.bucket_manager.iter_files(pathname,
+                                                       self.path_filter)
+            for item in files:
+                self.walk_stats.items += 1
+                self.hash_stats.put(self.hash_queue, item)
+        except OSError as error:
+            self._walk_error = error
+        finally:
+            for _ in range(self.workers):
+                self.hash_queue.put(None)
+        self.walk_stats.finish()
+        self.walk_stats.busy = \
+            self.walk_stats.finished - self.walk_stats.started
+
+    def _hash(self):
+        """Stage: hash (and compress) files, pass them on to be uploaded."""
+        while True:
+            item = self.hash_queue.get()
+            if item is None:
+                return
+            self.hash_stats.start()
+            (path, key, stat) = item
+            began = time.perf_counter()
+            try:
+                etag = self.bucket_manager.file_etag(path, key, stat=stat)
+                encoding = None
+                if self.compressor is not None:
+                    (path, etag, encoding) = self.compressor.compress(
+                        path, etag, mimetypes.guess_type(key)[0] or '')
+                item = (path, key, etag, encoding, None)
+            except Exception as error:  # pylint: disable=broad-except
+                item = (path, key, None, None, error)
+            self.hash_stats.add(time.perf_counter() - began)
+
+            with self._lock:
+                if not self._listing_done and \
+                        key not in self.bucket_manager.manifest:
+                    self._waiting.append(item)
+                    continue
+            self.upload_stats.put(self.upload_queue, item)
+
+    def _upload(self):
+        """Stage: compare files with the manifest and upload changed ones."""
+        while True:
+            item = self.upload_queue.get()
+            if item is None:
+                return
+            self.upload_stats.start()
+            (path, key, etag, encoding, error) = item
+            began = time.perf_counter()
+            # a key that failed to hash or upload was still seen locally,
+            # so it must not be deleted from the bucket
+            self.bucket_manager.manifest.mark_seen(key)
+            try:
+                if error is not None:
+                    raise error
+                action = self.bucket_manager.upload_file(
+                    self.bucket, path, key, etag=etag, encoding=encoding)
+                self.summary.record(action, key)
+                # without a listing any upload may have replaced an object
+                if action in ('uploaded', 'copied') and (
+                        key in self.bucket_manager.manifest or
+                        not self._listed):
+                    self.summary.record('overwritten', key)
+            except Exception as error:  # pylint: disable=broad-except
+                print("Upload of {} failed: {}".format(key, error))
+                self.summary.record_failure(key, error)
+            self.upload_stats.add(time.perf_counter() - began)
+
+    def run(self, pathname, delete=True, max_delete=None, files=None,
+            stale_keys=None):
+        """Sync pathname to the bucket.
+
+        files is a list of (path, key, stat) to upload instead of walking
+        pathname, and stale_keys the keys to delete instead of those not
+        found locally; both are given together.
+        """
+        origin = time.perf_counter()
+        self.summary.origin = origin
+        threads = [threading.Thread(target=self._walk,
+                                    args=(pathname, files))]
+        if files is None:
+            threads.append(threading.Thread(target=self._list))
+        else:
+            self._listed = False
+            self._listing_done = True
+        hashers = [threading.Thread(target=self._hash)
+                   for _ in range(self.workers)]
+        uploaders = [threading.Thread(target=self._upload)
+                     for _ in range(self.workers)]
+        for thread in threads + hashers + uploaders:
+            thread.daemon = True
+            thread.start()
+
+        # uploads can only end once every file is hashed and the listing
+        # has released any files it was holding back
+        for thread in threads + hashers:
+            thread.join()
+        self.hash_stats.finish()
+        for _ in uploaders:
+            self.upload_queue.put(None)
+        for thread in uploaders:
+            thread.join()
+        self.upload_stats.finish()
+
+        # without a complete manifest and a complete walk nothing can be
+        # safely deleted
+        if self._listing_error is not None:
+            raise self._listing_error
+        if self._walk_error is not None:
+            raise self._walk_error
+
+        if stale_keys is None:
+            stale_keys = list(self.bucket_manager.manifest.unseen())
+        if self.path_filter:
+            # keys outside the filter aren't part of this sync
+            stale_keys = [key for key in stale_keys
+                          if self.path_filter.covers(key)]
+        if not delete:
+            self.summary.delete_held = (len(stale_keys), "--no-delete given")
+        elif max_delete is not None and len(stale_keys) > max_delete:
+            self.summary.delete_held = (
+                len(stale_keys), "more than {} allowed".format(max_delete))
+        else:
+            self.delete_stats.start()
+            self.bucket_manager.delete_keys(self.bucket, stale_keys,
+                                            self.summary,
+                                            workers=self.workers)
+            self.delete_stats.finish()
+            self.delete_stats.add(
+                self.delete_stats.finished - self.delete_stats.started,
+                len(stale_keys))
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for adapting S3 request concurrency and bandwidth."""
+
+import threading
+import time
+
+# error codes S3 (and other services) use to ask clients to slow down
+THROTTLE_CODES = {
+    'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+    'RequestThrottled', 'TooManyRequestsException', '503',
+}
+
+
+class AdaptiveThrottle:
+    """Limit the S3 requests of one client with AIMD concurrency control.
+
+    Every request waits for one of limit slots before it is made.  While
+    responses come back without throttling and latency stays near the best
+    seen, the limit grows for every limit requests - doubling until the
+    first throttle, then by one (additive increase).  A SlowDown, 503 or
+    failed request halves it (multiplicative decrease), at most once per
+    in-flight generation of requests.  An optional token bucket caps the
+    bytes per second sent.  Hooks are registered on the client's events,
+    so every operation through it - uploads, multipart parts, listings,
+    deletes - is covered.
+    """
+
+    INITIAL_LIMIT = 8
+    # a request slower than this times the baseline latency holds growth
+    LATENCY_FACTOR = 2.0
+    # weight of a new sample in the smoothed latency
+    SMOOTHING = 0.2
+
+    def __init__(self, max_limit, initial_limit=None, max_bandwidth=None):
+        """Create an AdaptiveThrottle allowing up to max_limit requests.
+
+        max_bandwidth is in bytes per second; None means no cap.
+        """
+        self.max_limit = max_limit
+        self.limit = min(initial_limit or self.INITIAL_LIMIT, max_limit)
+        self.max_bandwidth = max_bandwidth
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._successes = 0
+        self._slow_start = True
+        # requests started after this one see the latest decrease
+        self._issued = 0
+        self._decreased_at = 0
+        self.latency = None
+        self.baseline = None
+        self._tokens = 0.0
+        self._refilled = time.monotonic()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Clear the counters reported by report."""
+        with self._cond:
+            self.requests = 0
+            self.throttled = 0
+            self.increases = 0
+            self.decreases = 0
+            self.lowest_limit = self.limit
+            self.highest_limit = self.limit
+            self.waited = 0.0
+            self.bandwidth_waited = 0.0
+
+    def register(self, client):
+        """Register the throttle for every request made through client."""
+        events = client.meta.events
+        events.register('before-call.s3', self._before_call)
+        events.register('after-call.s3', self._after_call)
+        events.register('after-call-error.s3', self._after_call_error)
+        events.register('needs-retry.s3', self._needs_retry)
+        events.register('before-send.s3', self._before_send)
+
+    def acquire(self):
+        """Wait for a request slot; return the request's generation."""
+        began = time.perf_counter()
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+            self._issued += 1
+            self.requests += 1
+            self.waited += time.perf_counter() - began
+
+            return self._issued
+
+    def release(self, generation, latency, throttled=False):
+        """Free a request slot and adapt the limit to how it went."""
+        with self._cond:
+            self._in_flight -= 1
+            if throttled:
+                self._throttled(generation)
+            else:
+                self._succeeded(latency)
+            self._cond.notify_all()
+
+    def _throttled(self, generation):
+        """Halve the limit, once for requests issued before the last cut."""
+        self.throttled += 1
+        self._successes = 0
+        self._slow_start = False
+        if generation <= self._decreased_at:
+            return
+        self._decreased_at = self._issued
+        if self.limit > 1:
+            self.limit //= 2
+            self.decreases += 1
+        self.lowest_limit = min(self.lowest_limit, self.limit)
+
+    def _succeeded(self, latency):
+        """Grow the limit once per limit healthy requests."""
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += (latency - self.latency) * self.SMOOTHING
+        if self.baseline is None or self.latency < self.baseline:
+            self.baseline = self.latency
+        if self.latency > self.baseline * self.LATENCY_FACTOR:
+            self._successes = 0
+            return
+
+        self._successes += 1
+        if self._successes >= self.limit and self.limit < self.max_limit:
+            self._successes = 0
+            self.limit = min(self.max_limit, self.limit * 2) \
+                if self._slow_start else self.limit + 1
+            self.increases += 1
+            self.highest_limit = max(self.highest_limit, self.limit)
+
+    def consume(self, size):
+        """Wait until size bytes may be sent under max_bandwidth."""
+        if not self.max_bandwidth or not size:
+            return
+        with self._cond:
+            now = time.monotonic()
+            self._tokens = min(
+                self.max_bandwidth,
+                self._tokens + (now - self._refilled) * self.max_bandwidth)
+            self._refilled = now
+            # going into debt lets requests larger than a second's worth
+            # through, at the cost of the ones after them waiting
+            self._tokens -= size
+            delay = -self._tokens / self.max_bandwidth \
+                if self._tokens < 0 else 0
+            self.bandwidth_waited += delay
+        if delay:
+            time.sleep(delay)
+
+    @staticmethod
+    def is_throttle(response):
+        """Return true if a (http_response, parsed) pair is a throttle."""
+        if response is None:
+            return False
+        (http_response, parsed) = response
+        code = parsed.get('Error', {}).get('Code')
+
+        return code in THROTTLE_CODES or http_response.status_code == 503
+
+    def _before_call(self, context, **kwargs):
+        """Event hook: take a slot before the request is made."""
+        context['throttle_generation'] = self.acquire()
+        context['throttle_started'] = time.perf_counter()
+
+    def _after_call(self, http_response, parsed, context, **kwargs):
+        """Event hook: give the slot back once the response is in."""
+        if 'throttle_generation' in context:
+            self.release(context.pop('throttle_generation'),
+                         time.perf_counter() - context['throttle_started'],
+                         self.is_throttle((http_response, parsed)))
+
+    def _after_call_error(self, context, **kwargs):
+        """Event hook: give the slot back after a failed request."""
+        if 'throttle_generation' in context:
+            self.release(context.pop('throttle_generation'),
+                         time.perf_counter() - context['throttle_started'],
+                         throttled=True)
+
+    def _needs_retry(self, response, request_dict, **kwargs):
+        """Event hook: cut the limit when a retried request was throttled."""
+        context = request_dict.get('context', {})
+        if self.is_throttle(response) and 'throttle_generation' in context:
+            with self._cond:
+                self._throttled(context['throttle_generation'])
+
+    def _before_send(self, request, **kwargs):
+        """Event hook: hold the request back to stay under max_bandwidth."""
+        # streamed uploads with a checksum trailer are sent aws-chunked,
+        # with the payload size in their own header
+        size = request.headers.get('X-Amz-Decoded-Content-Length') or \
+            request.headers.get('Content-Length')
+        self.consume(int(size or 0))
+
+    def report(self):
+        """Return the report lines for the throttle's decisions."""
+        lines = ["Throttle: {} requests, {} throttled, limit {} "
+                 "(range {}-{}, {} increases, {} decreases), "
+                 "{:.2f}s total waiting for a slot".format(
+                     self.requests, self.throttled, self.limit,
+                     self.lowest_limit, self.highest_limit, self.increases,
+                     self.decreases, self.waited)]
+        if self.max_bandwidth:
+            lines.append("Bandwidth: capped at {:.2f} MiB/s, {:.2f}s "
+                         "total delay".format(self.max_bandwidth / 1048576,
+                                              self.bandwidth_waited))
+
+        return lines
@@ -3,6 +3,11 @@
 """Provide utilities for webotron."""
 
 from collections import namedtuple
+from hashlib import md5
+import json
+import os
+from pathlib import Path
+import time
 
 Endpoint = namedtuple('Endpoint', ['name', 'host', 'zone'])
 
@@ -69,3 +74,94 @@ def known_region(region):
 def get_endpoint(region):
     """Get the s3 website hosing endpoint for this region."""
     return REGION_TO_ENDPOINT[region]
+
+
+def get_cache_dir():
+    """Get (and create) the directory webotron keeps its local caches in."""
+    base = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    cache_dir = Path(base) / 'webotron'
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    return cache_dir
+
+
+def check_writable(path):
+    """Raise OSError unless a file can be written in place of path.
+
+    Files are replaced by writing a temporary file next to them, so that
+    is what is tried.
+    """
+    probe = '{}.probe{}'.format(path, os.getpid())
+    with open(probe, 'w'):
+        pass
+    os.remove(probe)
+
+
+def get_account_cache_path(session, name):
+    """Get the cache file name for the session's credentials, or None.
+
+    Caches of account resources are kept apart per access key, so
+    switching profiles never mixes them up.
+    """
+    credentials = session.get_credentials()
+    if credentials is None:
+        return None
+    owner = md5(credentials.access_key.encode('utf-8')).hexdigest()
+
+    return get_cache_dir() / '{}-{}.json'.format(name, owner)
+
+
+def read_account_cache(session, name, ttl=None):
+    """Read what write_account_cache stored for the session's account.
+
+    Return a tuple of the data and when it was stored, or None if there
+    is no usable cache - none at all, an unreadable one or, with ttl, one
+    more than ttl seconds old.
+    """
+    try:
+        path = get_account_cache_path(session, name)
+        if path is None:
+            return None
+        with open(path, 'r') as f:
+            cache = json.load(f)
+        if ttl is not None and cache['fetched'] < time.time() - ttl:
+            return None
+        return (cache['data'], cache['fetched'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def write_account_cache(session, name, data, fetched=None):
+    """Store data for the session's account as JSON, atomically.
+
+    fetched is when the data was fetched from AWS, by default now.
+    """
+    try:
+        path = get_account_cache_path(session, name)
+        if path is None:
+            return
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'fetched': fetched or time.time(), 'data': data}, f,
+                      separators=(',', ':'))
+        os.replace(str(tmp_path), str(path))
+    except OSError:
+        # the cache only saves time; a read-only home shouldn't fail
+        pass
+
+
+def resolve_with_refresh(names, resolve, cached, refresh):
+    """Resolve each of names, refreshing a cached index once on a miss.
+
+    resolve looks a name up in the current index and refresh reloads the
+    index from AWS.  When cached says the index came from the cache,
+    names it has nothing for are looked up again after one refresh, in
+    case they were created since.  Return a dict of name to result.
+    """
+    results = {name: resolve(name) for name in names}
+    if cached and None in results.values():
+        refresh()
+        results = {name: result or resolve(name)
+                   for (name, result) in results.items()}
+
+    return results
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for waiting on many CloudFront deployments at once."""
+
+import time
+
+
+class DeployWaiter:
+    """Wait for CloudFront distributions and invalidations to finish.
+
+    Everything tracked is polled together: one ListDistributions sweep
+    per tick covers every distribution, and the newest page or so of
+    ListInvalidations covers all the invalidations of a distribution.
+    The delay between ticks grows by BACKOFF from MIN_DELAY to MAX_DELAY
+    while nothing finishes, and drops back to MIN_DELAY when something
+    does, as deployments started together tend to finish together.
+    """
+
+    MIN_DELAY = 5
+    MAX_DELAY = 60
+    BACKOFF = 1.5
+
+    def __init__(self, client):
+        """Create a DeployWaiter object polling through client."""
+        self.client = client
+        # label: distribution Id
+        self.distributions = {}
+        # label: (distribution Id, invalidation Id)
+        self.invalidations = {}
+        # label: seconds taken, once finished
+        self.finished = {}
+        self.started = time.monotonic()
+
+    def track_distribution(self, dist_id, label=None):
+        """Wait for distribution dist_id to be deployed."""
+        self.distributions[label or dist_id] = dist_id
+
+    def track_invalidation(self, dist_id, invalidation_id, label=None):
+        """Wait for an invalidation of dist_id to complete."""
+        self.invalidations[label or invalidation_id] = (dist_id,
+                                                        invalidation_id)
+
+    def pending(self):
+        """List the labels of everything not finished yet."""
+        return [label for label in
+                list(self.distributions) + list(self.invalidations)
+                if label not in self.finished]
+
+    def _deployed_ids(self):
+        """Get the Ids of every deployed distribution in one sweep."""
+        deployed = set()
+        paginator = self.client.get_paginator('list_distributions')
+        for page in paginator.paginate():
+            for dist in page['DistributionList'].get('Items', []):
+                if dist['Status'] == 'Deployed':
+                    deployed.add(dist['Id'])
+
+        return deployed
+
+    def _completed_ids(self, dist_id, invalidation_ids):
+        """Get which of invalidation_ids of dist_id have completed.
+
+        The list is newest first, so paging stops once every one of
+        invalidation_ids has been seen rather than going through the
+        whole history of the distribution.
+        """
+        completed = set()
+        unseen = set(invalidation_ids)
+        paginator = self.client.get_paginator('list_invalidations')
+        for page in paginator.paginate(DistributionId=dist_id):
+            for item in page['InvalidationList'].get('Items', []):
+                unseen.discard(item['Id'])
+                if item['Status'] == 'Completed' and \
+                        item['Id'] in invalidation_ids:
+                    completed.add(item['Id'])
+            if not unseen:
+                break
+
+        return completed
+
+    def poll(self):
+        """Check everything pending once; return the labels now done."""
+        done = []
+        pending = set(self.pending())
+        if pending & set(self.distributions):
+            deployed = self._deployed_ids()
+            done.extend(label for (label, dist_id)
+                        in self.distributions.items()
+                        if label in pending and dist_id in deployed)
+        waiting = {}
+        for (label, (dist_id, invalidation_id)) in self.invalidations.items():
+            if label in pending:
+                waiting.setdefault(dist_id, set()).add(invalidation_id)
+        completed = set()
+        for (dist_id, invalidation_ids) in waiting.items():
+            completed |= self._completed_ids(dist_id, invalidation_ids)
+        done.extend(label for (label, (_, invalidation_id))
+                    in self.invalidations.items()
+                    if label in pending and invalidation_id in completed)
+
+        elapsed = time.monotonic() - self.started
+        for label in done:
+            self.finished[label] = elapsed
+
+        return done
+
+    def wait(self, timeout=1800, progress=None):
+        """Poll until everything is finished or timeout seconds pass.
+
+        progress, when given, is called with a line of text whenever
+        something finishes.  Return a dict of each label to the seconds
+        it took, or None for those still unfinished.
+        """
+        deadline = self.started + timeout
+        delay = self.MIN_DELAY
+        total = len(self.distributions) + len(self.invalidations)
+        while True:
+            done = self.poll()
+            count = len(self.finished) - len(done)
+            for label in done:
+                count += 1
+                if progress is not None:
+                    progress("{} finished after {:.0f}s ({} of {} done)"
+                             .format(label, self.finished[label], count,
+                                     total))
+            if not self.pending():
+                break
+            now = time.monotonic()
+            if now + delay > deadline:
+                break
+            time.sleep(delay)
+            delay = self.MIN_DELAY if done else \
+                min(delay * self.BACKOFF, self.MAX_DELAY)
+
+        return {label: self.finished.get(label) for label in
+                list(self.distributions) + list(self.invalidations)}
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+"""Classes for keeping a bucket in step with a directory as it changes."""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+from pathlib import Path
+import time
+
+from webotron.scanner import PathFilter, scan_tree
+from webotron.sync import SyncSummary
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:  # inotify_simple is optional - changes are then polled
+    INotify = None
+
+
+def signature(stat):
+    """Get the parts of a stat result that change when a file does."""
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+class PollingSource:
+    """Find changed files by rescanning the tree every interval seconds.
+
+    Only directory entries are read and compared, so a poll of an
+    unchanged tree costs no file reads.
+    """
+
+    def __init__(self, root, path_filter, interval=1.0):
+        """Create a PollingSource object for the tree at root."""
+        self.root = root
+        self.path_filter = path_filter
+        self.interval = interval
+        self.files = self._scan()
+
+    def _scan(self):
+        return {key: signature(stat) for (path, key, stat)
+                in scan_tree(self.root, self.path_filter)}
+
+    def wait(self, timeout=None):
+        """Wait for changes; return the set of keys that changed.
+
+        timeout None waits for as long as it takes.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self.interval if deadline is None else \
+                min(self.interval, max(0, deadline - time.monotonic()))
+            time.sleep(delay)
+            files = self._scan()
+            changed = {key for (key, sig) in files.items()
+                       if self.files.get(key) != sig}
+            changed.update(key for key in self.files if key not in files)
+            self.files = files
+            if changed or (deadline is not None and
+                           time.monotonic() >= deadline):
+                return changed
+
+    def close(self):
+        """Release the source's resources."""
+
+
+class InotifySource:
+    """Find changed files and directories from inotify events."""
+
+    def __init__(self, root, path_filter):
+        """Create an InotifySource object watching the tree at root."""
+        self.root = root
+        self.path_filter = path_filter
+        self.inotify = INotify()
+        self.mask = flags.CREATE | flags.CLOSE_WRITE | flags.DELETE | \
+            flags.MOVED_FROM | flags.MOVED_TO | flags.ATTRIB | \
+            flags.DELETE_SELF
+        # watch descriptor: the key prefix of its directory
+        self.watches = {}
+        self._add_tree(root, '')
+
+    def _add_tree(self, directory, prefix):
+        """Watch directory and the subdirectories the filter allows."""
+        stack = [(directory, prefix)]
+        while stack:
+            (directory, prefix) = stack.pop()
+            try:
+                wd = self.inotify.add_watch(directory, self.mask)
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        key = prefix + entry.name
+                        if entry.is_dir() and not \
+                                self.path_filter.dir_excluded(key,
+                                                              entry.name):
+                            stack.append((entry.path, key + '/'))
+            except OSError:
+                # removed again before it could be watched
+                continue
+            self.watches[wd] = prefix
+
+    def wait(self, timeout=None):
+        """Wait for changes; return the set of changed keys.
+
+        The keys may be files or directories, either of which may no
+        longer exist.  None means events were lost and everything must be
+        checked.
+        """
+        changed = set()
+        events = self.inotify.read(
+            timeout=None if timeout is None else int(timeout * 1000))
+        for event in events:
+            if event.mask & flags.Q_OVERFLOW:
+                return None
+            if event.mask & flags.IGNORED:
+                self.watches.pop(event.wd, None)
+                continue
+            prefix = self.watches.get(event.wd)
+            if prefix is None:
+                continue
+            if not event.name:
+                # the watched directory itself went away
+                changed.add(prefix.rstrip('/'))
+                continue
+            key = prefix + event.name
+            if event.mask & flags.ISDIR:
+                if self.path_filter.dir_excluded(key, event.name):
+                    continue
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    self._add_tree(os.path.join(self.root, *key.split('/')),
+                                   key + '/')
+            changed.add(key)
+
+        return changed
+
+    def close(self):
+        """Stop watching."""
+        self.inotify.close()
+
+
+class SiteWatcher:
+    """Keep a bucket in step with a local directory as files change.
+
+    The bucket is listed once into the bucket manager's manifest, which is
+    then kept up to date in memory.  Changes are picked up from inotify
+    where the optional inotify_simple package and the platform support
+    it, and by polling directory entries otherwise.  A burst of changes -
+    an editor saving, a build writing its output - is gathered until
+    things are quiet for DEBOUNCE seconds (or MAX_DELAY has passed) and
+    then only the affected keys are uploaded or deleted.
+    """
+
+    DEBOUNCE = 0.3
+    MAX_DELAY = 1.5
+
+    def __init__(self, bucket_manager, pathname, bucket_name, workers=1,
+                 delete=True, path_filter=None, poll=False, interval=1.0):
+        """Create a SiteWatcher object syncing pathname to bucket_name."""
+        self.bucket_manager = bucket_manager
+        self.root = str(Path(pathname).expanduser().resolve())
+        self.bucket = bucket_manager.get_bucket(bucket_name)
+        self.workers = workers
+        self.delete = delete
+        self.path_filter = path_filter or PathFilter()
+        self.poll = poll or INotify is None
+        self.interval = interval
+        self.source = None
+        # key: (path, signature) of every local file
+        self.files = {}
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def start(self):
+        """List the bucket, snapshot the tree and sync what differs."""
+        if self.poll:
+            self.source = PollingSource(self.root, self.path_filter,
+                                        self.interval)
+        else:
+            self.source = InotifySource(self.root, self.path_filter)
+        self.bucket_manager.load_manifest(self.bucket)
+        self.files = {key: (path, signature(stat)) for (path, key, stat)
+                      in scan_tree(self.root, self.path_filter)}
+        # keys with no local file, as a full sync would find them
+        removed = {key for key in self.bucket_manager.manifest
+                   if key not in self.files and self.path_filter.covers(key)}
+
+        return self.apply(set(self.files), removed)
+
+    def _rescan(self, key, changed, removed):
+        """Compare the files at or under key with the snapshot."""
+        path = self._path(key) if key else self.root
+        prefix = key + '/' if key else ''
+        if os.path.isdir(path):
+            current = {k: (p, signature(stat)) for (p, k, stat)
+                       in scan_tree(path, self.path_filter, prefix)}
+        elif os.path.isfile(path) and key and self.path_filter.covers(key):
+            current = {key: (path, signature(os.stat(path)))}
+        else:
+            current = {}
+
+        for (k, entry) in current.items():
+            if self.files.get(k) != entry:
+                changed.add(k)
+                self.files[k] = entry
+        old_keys = [k for k in self.files if k == key or k.startswith(prefix)]
+        for k in old_keys:
+            if k not in current:
+                removed.add(k)
+                del self.files[k]
+
+    def collect(self):
+        """Wait for a burst of changes; return (changed, removed) keys."""
+        hints = self.source.wait()
+        started = time.monotonic()
+        while hints is not None:
+            left = self.MAX_DELAY - (time.monotonic() - started)
+            if left <= 0:
+                break
+            more = self.source.wait(min(self.DEBOUNCE, left))
+            if more is None:
+                hints = None
+            elif not more:
+                break
+            else:
+                hints |= more
+
+        (changed, removed) = (set(), set())
+        if hints is None:
+            self._rescan('', changed, removed)
+            return (changed, removed)
+        rescanned = set()
+        for key in sorted(hints, key=len):
+            parts = key.split('/')
+            # a directory's rescan already covered the keys under it
+            if any('/'.join(parts[:depth]) in rescanned
+                   for depth in range(1, len(parts))):
+                continue
+            self._rescan(key, changed, removed)
+            rescanned.add(key)
+
+        return (changed - removed, removed)
+
+    def _upload(self, key):
+        """Upload key if its content differs from the manifest."""
+        (path, sig) = self.files[key]
+        manager = self.bucket_manager
+        etag = manager.file_etag(path, key)
+        action = manager.upload_file(self.bucket, path, key, etag=etag)
+        if action in ('uploaded', 'copied'):
+            manager.manifest.add(key, etag, sig[0])
+
+        return action
+
+    def apply(self, changed, removed):
+        """Upload changed keys and delete removed ones; return a summary."""
+        summary = SyncSummary()
+        changed = sorted(key for key in changed if key in self.files)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [(key, executor.submit(self._upload, key))
+                       for key in changed]
+            for (key, future) in futures:
+                try:
+                    summary.record(future.result(), key)
+                except Exception as error:  # pylint: disable=broad-except
+                    print("Upload of {} failed: {}".format(key, error))
+                    summary.record_failure(key, error)
+
+        manifest = self.bucket_manager.manifest
+        stale = [key for key in removed if key in manifest]
+        if stale and not self.delete:
+            summary.delete_held = (len(stale), "--no-delete given")
+        elif stale:
+            self.bucket_manager.delete_keys(self.bucket, stale, summary,
+                                            workers=self.workers)
+            for key in summary.deleted:
+                manifest.discard(key)
+
+        return summary
+
+    def run(self):
+        """Watch for changes and sync them until interrupted."""
+        summary = self.start()
+        print(summary.report()[0])
+        print("Watching {} ({})".format(
+            self.root, "polling" if self.poll else "inotify"))
+        try:
+            while True:
+                (changed, removed) = self.collect()
+                if not changed and not removed:
+                    continue
+                began = time.perf_counter()
+                summary = self.apply(changed, removed)
+                for line in summary.report():
+                    print(line)
+                print("Synced {} change(s) in {:.2f}s".format(
+                    len(changed) + len(removed),
+                    time.perf_counter() - began))
+        finally:
+            self.source.close()
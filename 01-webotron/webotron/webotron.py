@@ -14,14 +14,29 @@ Webotron automates the process of deploying static websites to AWS
 - Configure a Content Delivery Network and SSL with AWS Cloudfront
 """
 
+from contextlib import nullcontext
+from datetime import datetime, timedelta, timezone
 from pprint import pprint
+import sys
+import time
 import boto3
 import click
 
 from webotron.bucket import BucketManager
 from webotron.domain import DomainManager
 from webotron.certificate import CertificateManager
+from webotron.cachepolicy import CachePolicy
 from webotron.cdn import DistributionManager
+from webotron.compress import Compressor, available_encodings
+from webotron.etagindex import EtagIndex
+from webotron.fingerprint import Fingerprinter
+from webotron.invalidation import invalidation_paths
+from webotron.journal import SyncJournal
+from webotron.metrics import Metrics
+from webotron.listing import (AGGREGATE_FIELDS, FIELDS, PrefixAggregator,
+                              object_row, write_rows)
+from webotron.scanner import PathFilter
+from webotron.watch import SiteWatcher
 
 from webotron import util
 
@@ -30,13 +45,25 @@ bucket_manager = None
 domain_manager = None
 cert_manager = None
 dist_manager = None
+metrics = None
+
+
+def phase(name):
+    """Time a with statement as the phase name when metrics are on."""
+    return metrics.phase(name) if metrics is not None else nullcontext()
 
 
 @click.group()
 @click.option('--profile', default=None, help="Use a given AWS profile.")
-def cli(profile):
+@click.option('--metrics-json', default=None, type=click.Path(),
+              help="Write timings, byte counts and API call stats here.")
+@click.option('--metrics-prom', default=None, type=click.Path(),
+              help="Write the same metrics in Prometheus text format.")
+@click.pass_context
+def cli(ctx, profile, metrics_json, metrics_prom):
     """Webotron deploys websites to AWS."""
     global session, bucket_manager, domain_manager, cert_manager, dist_manager
+    global metrics
 
     session_cfg = {}
     if profile:
@@ -51,6 +78,27 @@ def cli(profile):
     cert_manager = CertificateManager(session)
     dist_manager = DistributionManager(session)
 
+    if metrics_json or metrics_prom:
+        metrics = Metrics()
+        for client in (bucket_manager.s3.meta.client, domain_manager.client,
+                       cert_manager.client, dist_manager.client):
+            metrics.register(client)
+        bucket_manager.metrics = metrics
+        ctx.call_on_close(lambda: write_metrics(
+            ctx.invoked_subcommand, metrics_json, metrics_prom))
+
+
+def write_metrics(command, metrics_json, metrics_prom):
+    """Write the metrics collected for command to the files asked for."""
+    metrics.add_phase('command_{}'.format(command),
+                      time.perf_counter() - metrics.started)
+    if metrics_json:
+        metrics.write_json(metrics_json)
+        print("Metrics written to {}".format(metrics_json))
+    if metrics_prom:
+        metrics.write_prometheus(metrics_prom)
+        print("Metrics written to {}".format(metrics_prom))
+
 
 @cli.command('list-buckets')
 def list_buckets():
@@ -61,11 +109,40 @@ def list_buckets():
 
 @cli.command('list-bucket-objects')
 @click.argument('bucket')
-def list_bucket_objects(bucket):
+@click.option('--shards', default=1, show_default=True,
+              type=click.IntRange(1, BucketManager.MAX_WORKERS),
+              help="Number of key prefixes to list in parallel.")
+@click.option('--prefix', default='', help="Only list keys under this prefix.")
+@click.option('--limit', default=None, type=click.IntRange(1),
+              help="Stop after this many objects.")
+@click.option('--format', 'output_format', default='text',
+              show_default=True, type=click.Choice(['text', 'jsonl', 'csv']),
+              help="Output format.")
+@click.option('--aggregate', is_flag=True,
+              help="Only print object count and bytes per prefix and "
+              "storage class.")
+@click.option('--depth', default=1, show_default=True,
+              type=click.IntRange(0),
+              help="Number of key parts in an --aggregate prefix.")
+def list_bucket_objects(bucket, shards, prefix, limit, output_format,
+                        aggregate, depth):
     """List objects in an S3 bucket."""
-    for obj in bucket_manager.all_objects(bucket):
-        print(obj)
-        # print(obj.bucket_name, obj.key)
+    objects = bucket_manager.list_objects(bucket, prefix=prefix,
+                                          shards=shards, limit=limit)
+    if aggregate:
+        aggregator = PrefixAggregator(depth=depth)
+        for obj in objects:
+            aggregator.add(obj)
+        write_rows(aggregator.rows(), sys.stdout, output_format,
+                   AGGREGATE_FIELDS)
+    elif output_format == 'text':
+        for obj in objects:
+            print("s3.ObjectSummary(bucket_name='{}', key='{}')".format(
+                bucket, obj['Key']))
+            # print(obj.bucket_name, obj.key)
+    else:
+        write_rows((object_row(obj) for obj in objects), sys.stdout,
+                   output_format, FIELDS)
 
 
 @cli.command('setup-bucket')
@@ -83,12 +160,232 @@ def setup_bucket(bucket):
 @cli.command('sync')
 @click.argument('pathname', type=click.Path(exists=True))
 @click.argument('bucket')
-def sync(pathname, bucket):
-    """Sync contents of PATHNAME to BUCKET."""
-    bucket_manager.sync(pathname, bucket)
+@click.option('--workers', default=1, show_default=True,
+              type=click.IntRange(1, BucketManager.MAX_WORKERS),
+              help="Number of files to hash and upload in parallel.")
+@click.option('--etag-index/--no-etag-index', default=True,
+              show_default=True,
+              help="Only re-hash files whose size/mtime/inode changed.")
+@click.option('--etag-index-file', default=None, type=click.Path(),
+              help="Where to keep the etag index (default: cache dir).")
+@click.option('--delete/--no-delete', default=True, show_default=True,
+              help="Delete keys from BUCKET that are not in PATHNAME.")
+@click.option('--max-delete', default=None, type=click.IntRange(0),
+              help="Skip deleting if more than this many keys are stale.")
+@click.option('--list-shards', default=1, show_default=True,
+              type=click.IntRange(1, BucketManager.MAX_WORKERS),
+              help="Number of key prefixes to list in parallel.")
+@click.option('--hash-processes', default=0, show_default=True,
+              type=click.IntRange(0),
+              help="Hash the parts of large files in this many processes.")
+@click.option('--exclude', multiple=True, metavar='GLOB',
+              help="Skip files and directories matching GLOB (repeatable).")
+@click.option('--include', multiple=True, metavar='GLOB',
+              help="Only sync files matching GLOB (repeatable).")
+@click.option('--compress', default=None,
+              type=click.Choice(available_encodings()),
+              help="Upload text assets compressed with this encoding.")
+@click.option('--compress-processes', default=None, type=click.IntRange(1),
+              help="Processes used to compress (default: one per CPU).")
+@click.option('--cache-rules', default=None,
+              type=click.Path(exists=True, dir_okay=False),
+              help="JSON file mapping path globs to Cache-Control headers.")
+@click.option('--fingerprint', is_flag=True,
+              help="Give assets content-hashed names and immutable caching.")
+@click.option('--invalidate', default=None, metavar='DOMAIN',
+              help="Invalidate changed keys on DOMAIN's CloudFront dist.")
+@click.option('--wait', is_flag=True,
+              help="Wait for the invalidation to complete.")
+@click.option('--journal/--no-journal', default=True, show_default=True,
+              help="Checkpoint uploads so an interrupted sync resumes.")
+@click.option('--max-bandwidth', default=None,
+              type=click.FloatRange(0, min_open=True), metavar='MB/S',
+              help="Cap upload bandwidth at this many MiB per second.")
+@click.option('--git-delta', is_flag=True,
+              help="Only sync files git says changed since the last deploy.")
+@click.option('--dedup/--no-dedup', default=True, show_default=True,
+              help="Copy duplicate content server side instead of uploading.")
+def sync(pathname, bucket, workers, etag_index, etag_index_file, delete,
+         max_delete, list_shards, hash_processes, exclude, include,
+         compress, compress_processes, cache_rules, fingerprint, invalidate,
+         wait, journal, max_bandwidth, git_delta, dedup):
+    """Sync contents of PATHNAME to BUCKET.
+
+    Keys excluded by --exclude/--include are neither uploaded nor deleted.
+    Cache-Control headers are only sent with uploads, so objects whose
+    content is unchanged keep their old headers.  With --journal a rerun
+    after an interrupted sync skips the files already uploaded and
+    carries on with large files from their last uploaded part.
+
+    With --git-delta the deployed commit is kept in BUCKET's tags, and
+    the next --git-delta sync uploads and deletes only the files changed
+    since then.  It falls back to a full sync without a recorded commit,
+    with its history missing, or with other options.  Syncing a tree with
+    uncommitted changes clears the recorded commit.
+    """
+    path_filter = PathFilter(include, exclude)
+    policy = CachePolicy.from_file(cache_rules) if cache_rules else None
+    if fingerprint:
+        fingerprinter = Fingerprinter(pathname, path_filter)
+        with phase('fingerprint'):
+            (pathname, fingerprinted_keys) = fingerprinter.build()
+        policy = policy or CachePolicy()
+        policy.immutable_keys = fingerprinted_keys
+        print("Fingerprinted {} assets".format(len(fingerprinted_keys)))
+    index = None
+    if etag_index:
+        try:
+            index = EtagIndex(etag_index_file) if etag_index_file \
+                else EtagIndex.for_root(pathname)
+            util.check_writable(index.path)
+        except OSError as error:
+            print("Warning: syncing without an etag index: {}".format(error))
+            index = None
+    compressor = None
+    if compress:
+        compressor = Compressor(compress, processes=compress_processes,
+                                chunk_size=BucketManager.CHUNK_SIZE)
+    sync_journal = None
+    if journal:
+        try:
+            sync_journal = SyncJournal.for_sync(bucket, pathname)
+        except OSError as error:
+            print("Warning: syncing without a journal: {}".format(error))
+    try:
+        with phase('sync'):
+            summary = bucket_manager.sync(
+                pathname, bucket, workers=workers, etag_index=index,
+                delete=delete, max_delete=max_delete,
+                list_shards=list_shards, hash_processes=hash_processes,
+                path_filter=path_filter, compressor=compressor,
+                cache_policy=policy, journal=sync_journal,
+                max_bandwidth=max_bandwidth and max_bandwidth * 1048576,
+                git_delta=git_delta, dedup=dedup)
+    finally:
+        if compressor is not None:
+            compressor.shutdown()
+        if sync_journal is not None:
+            sync_journal.close()
+    if metrics is not None:
+        metrics.add_stages(summary.stages)
+    for line in summary.report():
+        print(line)
+    if invalidate:
+        with phase('invalidate'):
+            invalidate_changes(invalidate, summary.changed_keys(), wait)
+    if summary.failed:
+        raise click.ClickException(
+            "{} file(s) failed to sync".format(len(summary.failed)))
 #   in below statement, bucket_manager.s3.Bucket(bucket) resolves to
 #   s3.Bucket(name='automatingawstomb-boto3d')
-    print(bucket_manager.get_bucket_url(bucket_manager.s3.Bucket(bucket)))
+    with phase('get_bucket_url'):
+        url = bucket_manager.get_bucket_url(bucket_manager.s3.Bucket(bucket))
+    print(url)
+
+
+@cli.command('watch')
+@click.argument('pathname', type=click.Path(exists=True, file_okay=False))
+@click.argument('bucket')
+@click.option('--workers', default=4, show_default=True,
+              type=click.IntRange(1, BucketManager.MAX_WORKERS),
+              help="Number of files to upload in parallel.")
+@click.option('--delete/--no-delete', default=True, show_default=True,
+              help="Delete keys from BUCKET when files are removed.")
+@click.option('--exclude', multiple=True, metavar='GLOB',
+              help="Skip files and directories matching GLOB (repeatable).")
+@click.option('--include', multiple=True, metavar='GLOB',
+              help="Only sync files matching GLOB (repeatable).")
+@click.option('--poll', is_flag=True,
+              help="Poll for changes even where inotify is available.")
+@click.option('--interval', default=1.0, show_default=True,
+              type=click.FloatRange(0.1),
+              help="Seconds between polls.")
+def watch(pathname, bucket, workers, delete, exclude, include, poll,
+          interval):
+    """Keep BUCKET in step with PATHNAME as files change.
+
+    The bucket is listed once; after that only the keys of changed,
+    added or removed files are uploaded or deleted.  Stop with Ctrl-C.
+    """
+    watcher = SiteWatcher(bucket_manager, pathname, bucket, workers=workers,
+                          delete=delete,
+                          path_filter=PathFilter(include, exclude),
+                          poll=poll, interval=interval)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        print("Stopped watching {}".format(pathname))
+
+
+def invalidate_changes(domain, keys, wait):
+    """Invalidate the CDN paths for changed keys on domain's dist."""
+    if not keys:
+        print("Nothing to invalidate")
+        return
+    dist = dist_manager.find_matching_dist(domain, wildcards=True)
+    if not dist:
+        print("Error: No distribution found for {}.".format(domain))
+        return
+    paths = invalidation_paths(keys)
+    invalidation = dist_manager.create_invalidation(dist['Id'], paths)
+    print("Invalidating {} path(s) for {} changed key(s): {}".format(
+        len(paths), len(keys), invalidation['Id']))
+    if wait:
+        print("Waiting for invalidation...")
+        if dist_manager.await_invalidation(dist['Id'], invalidation):
+            print("Invalidation complete")
+        else:
+            print("Gave up waiting for invalidation {}".format(
+                invalidation['Id']))
+
+
+@cli.command('abort-uploads')
+@click.argument('bucket')
+@click.option('--older-than', default=24, show_default=True,
+              type=click.IntRange(0), metavar='HOURS',
+              help="Only abort uploads started at least HOURS ago.")
+def abort_uploads(bucket, older_than):
+    """Abort stale unfinished multipart uploads in BUCKET.
+
+    Parts of uploads that were never completed are stored, and billed,
+    until the upload is aborted.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=older_than)
+    aborted = bucket_manager.abort_uploads(bucket, older_than=cutoff)
+    for upload in aborted:
+        print("Aborted upload of {} started {}".format(
+            upload['Key'], upload['Initiated']))
+    print("Aborted {} upload(s)".format(len(aborted)))
+
+
+@cli.command('etag-index')
+@click.argument('pathname', type=click.Path(exists=True))
+@click.option('--etag-index-file', default=None, type=click.Path(),
+              help="Etag index to check (default: cache dir).")
+@click.option('--rebuild', is_flag=True,
+              help="Discard the index and re-hash every file.")
+def etag_index(pathname, etag_index_file, rebuild):
+    """Verify or rebuild the etag index for PATHNAME."""
+    index = EtagIndex(etag_index_file) if etag_index_file \
+        else EtagIndex.for_root(pathname)
+    files = list(bucket_manager.iter_files(pathname))
+    index.prune(key for (path, key, stat) in files)
+    if rebuild:
+        index.clear()
+        bucket_manager.etag_index = index
+        for (path, key, stat) in files:
+            bucket_manager.file_etag(path, key, stat=stat)
+        bucket_manager.etag_index = None
+        print("Rebuilt etag index for {} files".format(len(files)))
+    else:
+        bad_keys = index.verify(files, bucket_manager.gen_etag,
+                                BucketManager.CHUNK_SIZE)
+        for key in sorted(bad_keys):
+            print("Stale etag index entry corrected: {}".format(key))
+        print("Verified etag index: {} of {} files stale".format(
+            len(bad_keys), len(files)))
+    index.save()
+    print(index.path)
 
 
 @cli.command('setup-domain')
@@ -113,11 +410,65 @@ def setup_domain(domain):
     pprint(a_record)
 
 
+@cli.command('setup-domains')
+@click.argument('domains', nargs=-1, required=True)
+@click.option('--wait', is_flag=True,
+              help="Wait until Route 53 reports the records in sync.")
+@click.option('--timeout', default=600, show_default=True,
+              type=click.IntRange(1), help="Seconds to wait with --wait.")
+def setup_domains(domains, wait, timeout):
+    """Point each of DOMAINS at the bucket of the same name.
+
+    Records are grouped into as few Route 53 change batches as possible.
+    Domains need an existing hosted zone.
+    """
+    records = []
+    for domain in domains:
+        bucket = bucket_manager.get_bucket(domain)
+        endpoint = util.get_endpoint(bucket_manager.get_region_name(bucket))
+        records.append(domain_manager.s3_record(domain, endpoint))
+    (changes, missing) = domain_manager.upsert_records(records)
+    for domain in missing:
+        print("Error: No hosted zone found for {}".format(domain))
+    print("Submitted {} record(s) in {} change batch(es)".format(
+        sum(len(change['Names']) for change in changes), len(changes)))
+    if not wait:
+        return
+    latencies = domain_manager.await_changes(changes, timeout=timeout)
+    for (domain, latency) in sorted(latencies.items()):
+        if latency is None:
+            print("{}: not in sync after {}s".format(domain, timeout))
+        else:
+            print("{}: in sync after {:.1f}s".format(domain, latency))
+
+
+@cli.command('find-zone')
+@click.argument('domains', nargs=-1, required=True)
+@click.option('--refresh', is_flag=True,
+              help="Ignore the cached hosted zone list.")
+def find_zone(domains, refresh):
+    """Find the most specific hosted zone of each of DOMAINS."""
+    domain_manager.load_zones(refresh=refresh)
+    zones = domain_manager.find_hosted_zones(domains)
+    for domain in domains:
+        zone = zones[domain]
+        print("{}: {}".format(domain, "{} ({})".format(
+            zone['Name'], zone['Id']) if zone else None))
+
+
 @cli.command('find-cert')
-@click.argument('domain')
-def find_cert(domain):
-    """Find matching cert."""
-    print(cert_manager.find_matching_cert(domain))
+@click.argument('domains', nargs=-1, required=True)
+@click.option('--refresh', is_flag=True,
+              help="Ignore the cached certificate names.")
+def find_cert(domains, refresh):
+    """Find matching cert for each of DOMAINS."""
+    cert_manager.load_index(refresh=refresh)
+    certs = cert_manager.find_matching_certs(domains)
+    if len(domains) == 1:
+        print(certs[domains[0]])
+        return
+    for domain in domains:
+        print("{}: {}".format(domain, certs[domain]))
 
 
 @cli.command('setup-cdn')
@@ -135,7 +486,10 @@ def setup_cdn(domain, bucket):
         # if we have cert, create a Distribution
         dist = dist_manager.create_dist(domain, cert)
         print("Waiting for CDN deployment...")
-        dist_manager.await_deploy(dist)
+        if not dist_manager.await_deploy(dist):
+            print("Error: Gave up waiting for distribution {}".format(
+                dist['Id']))
+            return
     zone = domain_manager.find_hosted_zone(domain) \
         or domain_manager.create_hosted_zone(domain)
 
@@ -145,5 +499,47 @@ def setup_cdn(domain, bucket):
     return
 
 
+@cli.command('setup-cdns')
+@click.argument('domains', nargs=-1, required=True)
+@click.option('--timeout', default=1800, show_default=True,
+              type=click.IntRange(1),
+              help="Seconds to wait for the distributions to deploy.")
+def setup_cdns(domains, timeout):
+    """Establish Cloud Distribution Networks for many DOMAINS at once.
+
+    Distributions are created for every domain that lacks one and then
+    waited on together, so the whole run takes about as long as one
+    deployment.  Domains need an existing hosted zone.
+    """
+    dists = dist_manager.find_matching_dists(domains)
+    certs = cert_manager.find_matching_certs(
+        [domain for (domain, dist) in dists.items() if not dist])
+    waiter = dist_manager.waiter()
+    for (domain, cert) in certs.items():
+        if not cert:  # SSL is not optional at this time
+            print("Error: No matching cert found for {}.".format(domain))
+            del dists[domain]
+            continue
+        dists[domain] = dist_manager.create_dist(domain, cert)
+        waiter.track_distribution(dists[domain]['Id'], domain)
+
+    if waiter.pending():
+        print("Waiting for {} CDN deployment(s)...".format(
+            len(waiter.pending())))
+        for (domain, seconds) in waiter.wait(timeout, print).items():
+            if seconds is None:
+                print("Error: Gave up waiting for {}'s distribution "
+                      "{}".format(domain, dists.pop(domain)['Id']))
+
+    (changes, missing) = domain_manager.upsert_records(
+        [domain_manager.cf_record(domain, dist['DomainName'])
+         for (domain, dist) in dists.items()])
+    for domain in missing:
+        print("Error: No hosted zone found for {}".format(domain))
+    for change in changes:
+        for domain in change['Names']:
+            print("Domain configured:  https://{}".format(domain))
+
+
 if __name__ == '__main__':
     cli()